@@ -0,0 +1,580 @@
+"""Step-time benchmarks for the training code paths.
+
+Runs on random frames, so no environment or data collection is needed. Every training flag from
+scripts/train.py is accepted, e.g.
+
+    python -m scripts.benchmarks concat-forward --method slot-stdim --losses scn sdl --batch-size 128
+"""
+import copy
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from scripts.train import get_argparser, get_encoder
+from src import cswm_utils
+from src.compilation import compile_model, export_scripted_encoder, to_channels_last
+from src.contrastive import blocked_info_nce
+from src.quantization import quantize_encoder
+from src.logger import JSONLBackend, SQLiteBackend, MetricsLogger
+from src.memory_model import peak_memory
+from src.multi_seed import MultiSeedModel
+from src.distributed import DistributedModel
+from src.running_metrics import RunningMetrics
+from src.utils import get_autocast, get_grad_scaler
+from src.baselines.cswm import ContrastiveSWM, TransitionGNN
+from src.baselines.slot_stdim import SlotSTDIMModel
+from src.baselines.stdim import STDIMModel
+
+
+class _UnbufferedJSONLLogger(object):
+    """what logging used to cost: a host sync and a blocking write for every single log call"""
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def log(self, metrics):
+        metrics = {k: float(v) for k, v in metrics.items()}
+        self.file.write(json.dumps(metrics) + "\n")
+        self.file.flush()
+
+    def step(self):
+        pass
+
+
+def no_logging():
+    """a logger that accumulates like the real one but never writes anything"""
+    return RunningMetrics(log_fn=lambda metrics: None, interval=20)
+
+
+def get_bench_args():
+    parser = get_argparser()
+    parser.add_argument("bench", type=str, choices=list(BENCHMARKS.keys()))
+    parser.add_argument("--num-steps", type=int, default=20)
+    parser.add_argument("--num-warmup-steps", type=int, default=3)
+    parser.add_argument("--frame-shape", nargs=3, type=int, default=(3, 210, 160))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[128, 256, 512, 1024])
+    parser.add_argument("--queue-lens", nargs="+", type=int, default=[0, 1024, 4096, 16384])
+    parser.add_argument("--sampled-negatives", nargs="+", type=int, default=[0, 32, 128, 512])
+    parser.add_argument("--seed-counts", nargs="+", type=int, default=[2, 4, 8])
+    parser.add_argument("--process-counts", nargs="+", type=int, default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    if args.losses is None:
+        args.losses = ["scn", "sdl"]
+    return args
+
+
+def make_batch(args, device, batch_size=None, action_dim=18):
+    batch_size = args.batch_size if batch_size is None else batch_size
+    xt = torch.rand(batch_size, *args.frame_shape, device=device)
+    a = torch.randint(action_dim, (batch_size,), device=device)
+    xtp1 = torch.rand(batch_size, *args.frame_shape, device=device)
+    return xt, a, xtp1
+
+
+def build_model(args, device, logger=None, action_dim=18):
+    """builds encoder + model like scripts/train.get_model does, without touching gym or wandb"""
+    logger = no_logging() if logger is None else logger
+    sample_frame = torch.zeros(1, *args.frame_shape)
+    encoder = get_encoder(args, sample_frame)
+    if args.method == "cswm":
+        model = ContrastiveSWM(encoder=encoder,
+                               embedding_dim=args.slot_len,
+                               hidden_dim=args.hidden_dim,
+                               action_dim=action_dim,
+                               num_objects=args.num_slots,
+                               sigma=args.sigma,
+                               hinge=args.hinge,
+                               ignore_action=args.ignore_action,
+                               copy_action=args.copy_action,
+                               concat_forward=args.concat_forward,
+                               dense_transition=args.dense_transition,
+                               num_negatives=args.cswm_negatives)
+        model.apply(cswm_utils.weights_init)
+    elif args.method == "stdim":
+        model = STDIMModel(encoder, args, args.slot_len * args.num_slots, device, logger)
+    elif args.method == "slot-stdim":
+        model = SlotSTDIMModel(encoder, args, device, logger)
+    else:
+        assert False, "no benchmark for method {}".format(args.method)
+    return model.to(device)
+
+
+def time_train_steps(model, batch, num_steps, num_warmup_steps, logger=None, precision="fp32"):
+    """mean wall-clock seconds of one forward + backward + optimizer step (+ the per-batch logging of do_epoch)"""
+    optimizer = torch.optim.Adam(model.parameters(), lr=3e-4)
+    scaler = get_grad_scaler(batch[0].device, precision)
+    model.train()
+    for step in range(num_warmup_steps + num_steps):
+        if step == num_warmup_steps:
+            if batch[0].is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        with get_autocast(batch[0].device, precision):
+            loss = model.calc_loss(*batch)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        if logger is not None:
+            logger.log(dict(tr_loss=loss))
+            logger.step()
+    if batch[0].is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps
+
+
+def report(name, rows):
+    """prints a small table of (config, seconds per step) rows, relative to the first row"""
+    print("== %s" % name)
+    base = rows[0][1]
+    for config, seconds in rows:
+        print("%-40s %9.2f ms/step  %5.2fx" % (config, 1000 * seconds, base / seconds))
+
+
+def bench_concat_forward(args, device):
+    """separate xt/xtp1 encoder calls vs one concatenated 2N call"""
+    rows = []
+    for concat in [False, True]:
+        cfg = copy.deepcopy(args)
+        cfg.concat_forward = concat
+        torch.manual_seed(args.seed)
+        model = build_model(cfg, device)
+        batch = make_batch(cfg, device)
+        seconds = time_train_steps(model, batch, args.num_steps, args.num_warmup_steps)
+        rows.append(("concat=%s" % concat, seconds))
+    report("concat-forward %s bs=%i" % (args.method, args.batch_size), rows)
+
+
+def bench_logging(args, device):
+    """per-step cost of the logging path: unbuffered per-call logging vs the buffered asynchronous logger"""
+    log_dir = tempfile.mkdtemp()
+    loggers = [("no logging", None),
+               ("unbuffered jsonl (sync per call)", _UnbufferedJSONLLogger(os.path.join(log_dir, "unbuffered.jsonl"))),
+               ("MetricsLogger no backend", MetricsLogger([], interval=args.log_interval)),
+               ("MetricsLogger jsonl", MetricsLogger([JSONLBackend(os.path.join(log_dir, "m.jsonl"))],
+                                                     interval=args.log_interval)),
+               ("MetricsLogger sqlite", MetricsLogger([SQLiteBackend(os.path.join(log_dir, "m.sqlite"))],
+                                                      interval=args.log_interval))]
+    rows = []
+    for name, logger in loggers:
+        torch.manual_seed(args.seed)
+        model = build_model(args, device, logger=logger)
+        batch = make_batch(args, device)
+        seconds = time_train_steps(model, batch, args.num_steps, args.num_warmup_steps, logger=logger)
+        if isinstance(logger, MetricsLogger):
+            logger.close()
+        rows.append((name, seconds))
+    report("logging %s bs=%i interval=%i" % (args.method, args.batch_size, args.log_interval), rows)
+    base = rows[0][1]
+    for name, seconds in rows[1:]:
+        print("%-40s %9.3f ms/step logging overhead" % (name, 1000 * (seconds - base)))
+
+
+def bench_blocked_infonce(args, device):
+    """dense vs blocked slot local-to-local InfoNCE: time, peak memory and agreement of loss and gradients"""
+    h, w = 11, 8  # f5 grid at 210 x 160
+    feat_maps_per_slot = 128 // args.num_slots
+    chunk_size = args.loss_chunk_size if args.loss_chunk_size > 0 else 64
+
+    def dense(queries, keys):
+        N = queries.shape[-2]
+        scores = torch.matmul(queries, keys.transpose(-1, -2)).reshape(-1, N)
+        target = torch.arange(N, device=device).repeat(scores.shape[0] // N)
+        return nn.CrossEntropyLoss()(scores, target)
+
+    def blocked(queries, keys):
+        return blocked_info_nce(queries, keys, chunk_size)[0]
+
+    print("== blocked-infonce num_slots=%i chunk_size=%i" % (args.num_slots, chunk_size))
+    for N in args.batch_sizes:
+        torch.manual_seed(args.seed)
+        queries = torch.randn(args.num_slots, h, w, N, feat_maps_per_slot, device=device, requires_grad=True)
+        keys = torch.randn(args.num_slots, h, w, N, feat_maps_per_slot, device=device, requires_grad=True)
+        results = {}
+        for name, loss_fn in [("dense", dense), ("blocked", blocked)]:
+            def step():
+                queries.grad, keys.grad = None, None
+                start = time.perf_counter()
+                loss = loss_fn(queries, keys)
+                loss.backward()
+                return loss.item(), time.perf_counter() - start
+            try:
+                (loss, seconds), peak = peak_memory(step, device)
+            except RuntimeError as e:  # out of memory
+                print("N=%-6i %-8s failed: %s" % (N, name, str(e).splitlines()[0]))
+                continue
+            results[name] = (loss, queries.grad.clone(), keys.grad.clone())
+            print("N=%-6i %-8s %9.1f ms  peak %8.1f MB  loss %.6f" % (N, name, 1000 * seconds, peak / 2**20, loss))
+        if len(results) == 2:
+            (l1, gq1, gk1), (l2, gq2, gk2) = results["dense"], results["blocked"]
+            print("N=%-6i max |dloss| %.2e  max |dgrad_q| %.2e  max |dgrad_k| %.2e"
+                  % (N, abs(l1 - l2), (gq1 - gq2).abs().max().item(), (gk1 - gk2).abs().max().item()))
+
+
+def bench_negative_queue(args, device):
+    """step time and memory of the slot time-contrastive losses with a momentum-encoder negative queue"""
+    print("== negative-queue %s bs=%i losses=%s" % (args.method, args.batch_size, " ".join(args.losses)))
+    base = None
+    for queue_len in args.queue_lens:
+        cfg = copy.deepcopy(args)
+        cfg.queue_len = queue_len
+        torch.manual_seed(args.seed)
+        model = build_model(cfg, device)
+        batch = make_batch(cfg, device)
+        seconds, peak = peak_memory(lambda: time_train_steps(model, batch, args.num_steps, args.num_warmup_steps),
+                                    device)
+        queue_bytes = 0 if model.negative_queue is None else model.negative_queue.queue.numel() * 4
+        base = seconds if base is None else base
+        print("queue_len=%-7i negatives/anchor=%-7i %9.2f ms/step  %5.2fx  peak %8.1f MB  queue %7.1f MB"
+              % (queue_len, args.batch_size - 1 + queue_len, 1000 * seconds, seconds / base,
+                 peak / 2**20, queue_bytes / 2**20))
+
+
+def bench_sampled_softmax(args, device):
+    """step time and peak memory of exact (K=0) vs sampled-softmax slot contrastive losses
+
+    downstream probe R^2 of the two modes has to come from full runs:
+    scripts/train.py --num-sampled-negatives K followed by scripts/eval.py on each run
+    """
+    print("== sampled-softmax %s bs=%i losses=%s" % (args.method, args.batch_size, " ".join(args.losses)))
+    base = None
+    for num_negatives in args.sampled_negatives:
+        cfg = copy.deepcopy(args)
+        cfg.num_sampled_negatives = num_negatives
+        torch.manual_seed(args.seed)
+        model = build_model(cfg, device)
+        batch = make_batch(cfg, device)
+        seconds, peak = peak_memory(lambda: time_train_steps(model, batch, args.num_steps, args.num_warmup_steps),
+                                    device)
+        base = seconds if base is None else base
+        print("K=%-6s %9.2f ms/step  %5.2fx  peak %8.1f MB"
+              % (num_negatives if num_negatives > 0 else "exact", 1000 * seconds, base / seconds, peak / 2**20))
+
+
+def bench_checkpointing(args, device):
+    """peak memory saved vs extra compute per step for each activation checkpointing configuration"""
+    segments = ["f5", "global-head"] if args.method == "stdim" else ["f5", "slot-head"]
+    configs = [[], [segments[0]], [segments[1]], segments]
+    print("== checkpointing %s bs=%i" % (args.method, args.batch_size))
+    base = None
+    for checkpoint_segments in configs:
+        cfg = copy.deepcopy(args)
+        cfg.checkpoint_segments = checkpoint_segments
+        torch.manual_seed(args.seed)
+        model = build_model(cfg, device)
+        batch = make_batch(cfg, device)
+        seconds, peak = peak_memory(lambda: time_train_steps(model, batch, args.num_steps, args.num_warmup_steps),
+                                    device)
+        base = (seconds, peak) if base is None else base
+        print("%-22s %9.2f ms/step (%+6.1f%%)  peak %8.1f MB (%+6.1f%%)"
+              % (",".join(checkpoint_segments) or "none", 1000 * seconds, 100 * (seconds / base[0] - 1),
+                 peak / 2**20, 100 * (peak / base[1] - 1)))
+
+
+def probe_agreement(encoder, other_encoder, frames):
+    """R^2 of a linear probe from other_encoder's features to encoder's features on the same frames
+
+    1.0 means the two encoders carry the same linearly decodable information, which is what the downstream
+    linear probes see.
+    """
+    from sklearn.linear_model import LinearRegression
+    with torch.no_grad():
+        target = torch.cat([encoder(x).flatten(1).float().cpu() for x in frames.split(64)]).numpy()
+        features = torch.cat([other_encoder(x).flatten(1).float().cpu() for x in frames.split(64)]).numpy()
+    num_train = len(frames) // 2
+    probe = LinearRegression().fit(features[:num_train], target[:num_train])
+    return probe.score(features[num_train:], target[num_train:])
+
+
+def bench_precision(args, device):
+    """fp32 vs bf16 (autocast) step time and peak memory for each contrastive method, plus how closely the
+    bf16-trained encoder agrees with the fp32-trained one when both start from the same weights"""
+    precisions = ["fp32", "bf16"] + (["fp16"] if device.type == "cuda" else [])
+    for method in ["stdim", "slot-stdim", "cswm"]:
+        cfg = copy.deepcopy(args)
+        cfg.method = method
+        cfg.regime = "cswm" if method == "cswm" else "stdim"
+        torch.manual_seed(args.seed)
+        init_model = build_model(cfg, device)
+        batch = make_batch(cfg, device)
+        eval_frames = torch.rand(3 * cfg.slot_len * cfg.num_slots, *cfg.frame_shape, device=device)
+
+        print("== precision %s bs=%i" % (method, cfg.batch_size))
+        encoders, base = {}, None
+        for precision in precisions:
+            model = copy.deepcopy(init_model)
+            seconds, peak = peak_memory(lambda: time_train_steps(model, batch, args.num_steps,
+                                                                 args.num_warmup_steps, precision=precision),
+                                        device)
+            base = (seconds, peak) if base is None else base
+            encoders[precision] = model.encoder.eval()
+            agreement = probe_agreement(encoders["fp32"], encoders[precision], eval_frames)
+            print("%-6s %9.2f ms/step  %5.2fx  peak %8.1f MB (%+6.1f%%)  probe R^2 vs fp32 %.4f"
+                  % (precision, 1000 * seconds, base[0] / seconds, peak / 2**20,
+                     100 * (peak / base[1] - 1), agreement))
+
+
+def bench_compile(args, device):
+    """eager vs torch.compile vs TorchScript step time (the first compiled steps are part of the warmup)"""
+    rows = []
+    for mode in ["none", "compile", "script"]:
+        torch.manual_seed(args.seed)
+        model = build_model(args, device)
+        used_mode = compile_model(model, mode)
+        batch = make_batch(args, device)
+        if used_mode != "none":
+            batch = [to_channels_last(tensor) for tensor in batch]
+        rows.append((used_mode if used_mode == mode else "%s (fell back to %s)" % (mode, used_mode),
+                     time_train_steps(model, batch, args.num_steps, args.num_warmup_steps)))
+    report("compile %s bs=%i" % (args.method, args.batch_size), rows)
+
+
+def check_compile(args, device):
+    """trains one step of stdim and slot-stdim under every --compile mode at --frame-shape (the full 210 x 160
+    frames by default) and exports the scripted encoder of each, failing loudly instead of timing anything"""
+    export_dir = tempfile.mkdtemp()
+    for method in ["stdim", "slot-stdim"]:
+        for mode in ["none", "compile", "script"]:
+            cfg = copy.deepcopy(args)
+            cfg.method = method
+            torch.manual_seed(args.seed)
+            model = build_model(cfg, device)
+            used_mode = compile_model(model, mode)
+            batch = make_batch(cfg, device)
+            if used_mode != "none":
+                batch = [to_channels_last(tensor) for tensor in batch]
+            seconds = time_train_steps(model, batch, num_steps=1, num_warmup_steps=0)
+            path = os.path.join(export_dir, "%s_%s.pt" % (method, mode))
+            export_scripted_encoder(model.encoder, batch[0][:1], path)
+            print("%-10s --compile %-7s ok (%s): one step in %.2f s, exported %s"
+                  % (method, mode, used_mode, seconds, path))
+
+
+def bench_quantization(args, device):
+    """cpu probe feature extraction with the fp32 vs the static int8 encoder: frames/s and feature agreement"""
+    for method in ["stdim", "slot-stdim"]:
+        cfg = copy.deepcopy(args)
+        cfg.method = method
+        torch.manual_seed(args.seed)
+        encoder = get_encoder(cfg, torch.zeros(1, *cfg.frame_shape)).eval()
+        calibration_frames = torch.rand(512, *cfg.frame_shape)
+        frames = torch.rand(3 * cfg.slot_len * cfg.num_slots, *cfg.frame_shape)
+        quantized = quantize_encoder(encoder, calibration_frames)
+
+        rows = []
+        for name, model in [("fp32", encoder), ("int8", quantized)]:
+            def extract():
+                with torch.no_grad():
+                    for x in frames.split(cfg.batch_size):
+                        model(x)
+            extract()  # warmup
+            start = time.perf_counter()
+            extract()
+            rows.append((name, (time.perf_counter() - start) / len(frames.split(cfg.batch_size))))
+        report("quantization %s (one step = one batch of %i frames)" % (method, cfg.batch_size), rows)
+        print("probe R^2 of int8 features vs fp32 features %.4f" % probe_agreement(encoder, quantized, frames))
+
+
+def bench_fused_slot_head(args, device):
+    """reshape-based vs grouped-conv slot head, forward + backward from f5, over 4-16 slots"""
+    for num_slots in [4, 6, 8, 12, 16]:
+        torch.manual_seed(args.seed)
+        cfg = copy.deepcopy(args)
+        cfg.method, cfg.num_slots = "slot-stdim", num_slots
+        encoder = get_encoder(cfg, torch.zeros(1, *cfg.frame_shape)).to(device)
+        f5 = encoder.get_f5(torch.rand(args.batch_size, *args.frame_shape, device=device)).detach()
+        f5.requires_grad_(True)
+        heads = [("reshape", lambda: encoder.slot_maps_to_slots(encoder.f5_to_slot_maps(f5))),
+                 ("fused", lambda: encoder.f5_to_slots(f5))]
+
+        rows, outputs = [], []
+        for name, head in heads:
+            for step in range(args.num_warmup_steps + args.num_steps):
+                if step == args.num_warmup_steps:
+                    if device.type == "cuda":
+                        torch.cuda.synchronize()
+                    start = time.perf_counter()
+                f5.grad = None
+                slots = head()
+                slots.sum().backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            rows.append((name, (time.perf_counter() - start) / args.num_steps))
+            outputs.append((slots.detach(), f5.grad.clone()))
+        report("slot head, %i slots bs=%i" % (num_slots, args.batch_size), rows)
+        print("max abs diff: slots %.2e, f5 grad %.2e"
+              % ((outputs[0][0] - outputs[1][0]).abs().max(), (outputs[0][1] - outputs[1][1]).abs().max()))
+
+
+def bench_loss_configs(args, device):
+    """slot-stdim step time of the loss combinations from scripts/make_tables.py
+
+    the step with the encoder forward is timed, and the loss part alone on fixed encoder outputs too; run it
+    on a commit before the shared projections for the baseline numbers
+    """
+    rows, loss_rows = [], []
+    for losses in [["scn", "sdl"], ["hcn", "smdl"]]:
+        cfg = copy.deepcopy(args)
+        cfg.method, cfg.losses = "slot-stdim", losses
+        torch.manual_seed(args.seed)
+        model = build_model(cfg, device)
+        batch = make_batch(cfg, device)
+        rows.append(("_".join(losses), time_train_steps(model, batch, args.num_steps, args.num_warmup_steps)))
+
+        # losses only: swap in an encoder that just returns the precomputed intermediates
+        with torch.no_grad():
+            out_t, out_tp1 = model.encoder.get_intermediates(batch[0]), model.encoder.get_intermediates(batch[2])
+        outputs = {id(batch[0]): out_t, id(batch[2]): out_tp1}
+        for out in (out_t, out_tp1):
+            for v in out.values():
+                v.requires_grad_(True)
+        model.encoder.get_intermediates = lambda x: outputs[id(x)]
+        cfg.concat_forward = False
+        loss_rows.append(("_".join(losses), time_train_steps(model, batch, args.num_steps, args.num_warmup_steps)))
+    report("loss configs bs=%i" % args.batch_size, rows)
+    report("loss configs, losses only bs=%i" % args.batch_size, loss_rows)
+
+
+def bench_dense_transition(args, device):
+    """edge list vs dense TransitionGNN forward + backward for a range of object counts"""
+    action_dim = 18
+    for num_objects in [4, 8, 16, 32]:
+        torch.manual_seed(args.seed)
+        gnn = TransitionGNN(args.slot_len, args.hidden_dim, action_dim, num_objects,
+                            copy_action=args.copy_action).to(device)
+        states = torch.randn(args.batch_size, num_objects, args.slot_len, device=device, requires_grad=True)
+        action = torch.randint(action_dim, (args.batch_size,), device=device)
+
+        rows, outputs = [], []
+        for dense in [False, True]:
+            gnn.dense = dense
+            for step in range(args.num_warmup_steps + args.num_steps):
+                if step == args.num_warmup_steps:
+                    if device.type == "cuda":
+                        torch.cuda.synchronize()
+                    start = time.perf_counter()
+                states.grad = None
+                out = gnn(states, action)
+                out.sum().backward()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            rows.append(("dense" if dense else "edge list", (time.perf_counter() - start) / args.num_steps))
+            outputs.append((out.detach(), states.grad.clone()))
+        report("transition gnn, %i objects bs=%i" % (num_objects, args.batch_size), rows)
+        print("max abs diff: output %.2e, state grad %.2e"
+              % ((outputs[0][0] - outputs[1][0]).abs().max(), (outputs[0][1] - outputs[1][1]).abs().max()))
+
+
+def bench_cswm_negatives(args, device):
+    """C-SWM step time and peak memory: single random negative vs all / top-k hardest in-batch negatives"""
+    cfg = copy.deepcopy(args)
+    cfg.method, cfg.regime = "cswm", "cswm"
+    print("== cswm-negatives")
+    for batch_size in args.batch_sizes:
+        base = None
+        for num_negatives, name in [(1, "single random"), (0, "all"), (8, "8 hardest"), (32, "32 hardest")]:
+            cfg.cswm_negatives = num_negatives
+            torch.manual_seed(args.seed)
+            model = build_model(cfg, device)
+            batch = make_batch(cfg, device, batch_size=batch_size)
+            seconds, peak = peak_memory(lambda: time_train_steps(model, batch, args.num_steps,
+                                                                 args.num_warmup_steps), device)
+            base = (seconds, peak) if base is None else base
+            print("N=%-6i %-14s %9.2f ms/step (%+6.1f%%)  peak %8.1f MB (%+6.1f%%)"
+                  % (batch_size, name, 1000 * seconds, 100 * (seconds / base[0] - 1),
+                     peak / 2**20, 100 * (peak / base[1] - 1)))
+
+
+def bench_resolution(args, device):
+    """train step time at --downsample (84 x 84), half (105 x 80) and full (210 x 160) resolution"""
+    for method in ["stdim", "slot-stdim", "cswm"]:
+        rows = []
+        for height, width in [(210, 160), (105, 80), (84, 84)]:
+            cfg = copy.deepcopy(args)
+            cfg.method = method
+            cfg.regime = "cswm" if method == "cswm" else "stdim"
+            cfg.frame_shape = (args.frame_shape[0], height, width)
+            torch.manual_seed(args.seed)
+            model = build_model(cfg, device)
+            batch = make_batch(cfg, device)
+            rows.append(("%i x %i" % (height, width),
+                         time_train_steps(model, batch, args.num_steps, args.num_warmup_steps)))
+        report("resolution %s bs=%i" % (method, args.batch_size), rows)
+
+
+def bench_multi_seed(args, device):
+    """time to train S seeds for one step each: S sequential models vs one vmapped MultiSeedModel"""
+    batch = make_batch(args, device)
+    for num_seeds in args.seed_counts:
+        models = []
+        for seed in range(num_seeds):
+            torch.manual_seed(args.seed + seed)
+            models.append(build_model(args, device))
+        sequential = sum(time_train_steps(model, batch, args.num_steps, args.num_warmup_steps) for model in models)
+        multi_seed = MultiSeedModel(models, logger=no_logging())
+        vmapped = time_train_steps(multi_seed, batch, args.num_steps, args.num_warmup_steps)
+        report("multi-seed %s S=%i bs=%i" % (args.method, num_seeds, args.batch_size),
+               [("%i sequential runs" % num_seeds, sequential), ("vmapped", vmapped)])
+
+
+def _ddp_worker(rank, world_size, args, result_path):
+    os.environ["MASTER_ADDR"], os.environ["MASTER_PORT"] = "127.0.0.1", "29517"
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    # the machine's cores are split between the processes, like src.distributed.init_distributed does
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    device = torch.device("cpu")
+    torch.manual_seed(args.seed)
+    model = DistributedModel(build_model(args, device))
+    torch.manual_seed(args.seed + rank)
+    seconds = time_train_steps(model, make_batch(args, device), args.num_steps, args.num_warmup_steps)
+    if rank == 0:
+        with open(result_path, "w") as f:
+            json.dump(dict(seconds=seconds), f)
+    dist.destroy_process_group()
+
+
+def bench_ddp_scaling(args, device):
+    """cpu data parallel (gloo) throughput and scaling efficiency for --process-counts processes on this
+    machine, each with a --batch-size batch and the global batch as negatives"""
+    print("== ddp-scaling %s bs=%i per process, %i cores" % (args.method, args.batch_size, os.cpu_count()))
+    base_throughput = None
+    for world_size in args.process_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            result_path = os.path.join(tmp, "result.json")
+            mp.spawn(_ddp_worker, args=(world_size, args, result_path), nprocs=world_size)
+            seconds = json.load(open(result_path))["seconds"]
+        throughput = world_size * args.batch_size / seconds
+        base_throughput = throughput if base_throughput is None else base_throughput
+        efficiency = throughput / (world_size * base_throughput / args.process_counts[0])
+        print("%2i processes %9.2f ms/step %9.1f frames/s  %5.2fx  efficiency %5.1f%%"
+              % (world_size, 1000 * seconds, throughput, throughput / base_throughput, 100 * efficiency))
+
+
+BENCHMARKS = {"concat-forward": bench_concat_forward,
+              "logging": bench_logging,
+              "blocked-infonce": bench_blocked_infonce,
+              "negative-queue": bench_negative_queue,
+              "sampled-softmax": bench_sampled_softmax,
+              "checkpointing": bench_checkpointing,
+              "precision": bench_precision,
+              "compile": bench_compile,
+              "compile-check": check_compile,
+              "quantization": bench_quantization,
+              "fused-slot-head": bench_fused_slot_head,
+              "loss-configs": bench_loss_configs,
+              "dense-transition": bench_dense_transition,
+              "cswm-negatives": bench_cswm_negatives,
+              "resolution": bench_resolution,
+              "multi-seed": bench_multi_seed,
+              "ddp-scaling": bench_ddp_scaling}
+
+
+if __name__ == "__main__":
+    args = get_bench_args()
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    np.random.seed(args.seed)
+    BENCHMARKS[args.bench](args, device)
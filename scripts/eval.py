@@ -13,6 +13,7 @@ from src.data.dataloader import get_dataloaders
 from pathlib import Path
 import copy
 from src.evaluation.metrics import compute_dci_disentangling
+from src.quantization import quantize_encoder, get_calibration_frames
 
 
 def compute_slot_accuracy(encoder, tr_dl, test_dl, probe_model="lin_reg"):
@@ -52,7 +53,15 @@ if __name__ == "__main__":
     parser.add_argument("--entropy-threshold", type=float, default=0.6)
     parser.add_argument("--max-episode-steps", type=int, default=-1)
     parser.add_argument("--test", action='store_true', default=False)
+    parser.add_argument("--scripted-encoder", action='store_true', default=False,
+                        help="load the TorchScript encoder_scripted.pt saved by train.py instead of rebuilding "
+                             "the encoder class and loading encoder.pt")
+    parser.add_argument("--quantize", action='store_true', default=False,
+                        help="extract the probe features with a static int8 quantized encoder on the cpu")
+    parser.add_argument("--num-calibration-frames", type=int, default=2048,
+                        help="how many training frames to calibrate the int8 activation ranges on")
     args = parser.parse_args()
+    assert not (args.quantize and args.scripted_encoder), "--quantize needs the eager encoder, not the scripted one"
 
     tag = "test" if args.test else "eval"
     wandb.init(project=args.wandb_proj, dir=args.run_dir, tags=[tag])
@@ -65,7 +74,8 @@ if __name__ == "__main__":
         run = api.run(path=path)
         json_obj = run.file(name="wandb-metadata.json").download(root=wandb.run.dir + "/train_run", replace=True)
         train_args = json.load(open(json_obj.name))["args"]
-        file_obj = run.file(name="encoder.pt").download(root=wandb.run.dir, replace=True)
+        weights_name = "encoder_scripted.pt" if args.scripted_encoder else "encoder.pt"
+        file_obj = run.file(name=weights_name).download(root=wandb.run.dir, replace=True)
         weights_path = file_obj.name
         train_args = run.config
     except:
@@ -73,7 +83,7 @@ if __name__ == "__main__":
         print(path)
         json_obj = path / Path("wandb-metadata.json")
         train_args = json.load(open(str(json_obj)))["args"]
-        weights_path = path / Path("encoder.pt")
+        weights_path = path / Path("encoder_scripted.pt" if args.scripted_encoder else "encoder.pt")
         train_parser = get_train_argparser()
         train_args = train_parser.parse_args(train_args)
         train_args = train_args.__dict__
@@ -92,11 +102,17 @@ if __name__ == "__main__":
     print_memory("after episodes loaded")
 
 
-    encoder = get_encoder(args, sample_frame)
     print("Loading weights from %s" % weights_path)
-    encoder.load_state_dict(torch.load(weights_path, map_location=device))
+    if args.scripted_encoder:
+        encoder = torch.jit.load(str(weights_path), map_location=device)
+    else:
+        encoder = get_encoder(args, sample_frame)
+        encoder.load_state_dict(torch.load(weights_path, map_location=device))
     encoder.to(device)
     encoder.eval()
+    if args.quantize:
+        calibration_frames = get_calibration_frames(tr_dl, args.num_calibration_frames)
+        encoder = quantize_encoder(encoder, calibration_frames)
 
     print_memory("after encoder trained/loaded")
     f1s = []
@@ -0,0 +1,82 @@
+"""Multi-step latent prediction evaluation (Hits@k / MRR) of a trained C-SWM model
+
+    python -m scripts.eval_cswm --tr-dir <train run dir with model.pt> --num-steps 1 5 10
+
+Paths come either from a C-SWM hdf5 replay buffer (--paths-h5, read with cswm_utils.PathDataset) or from freshly
+collected episodes of the training environment, cut into non-overlapping paths.
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import gym
+import torch
+from torch.utils import data
+from scripts.train import get_argparser as get_train_argparser
+from scripts.train import get_encoder
+from src.baselines.cswm import ContrastiveSWM
+from src.cswm_utils import PathDataset
+from src.data.data_collection import get_transitions
+from src.evaluation.cswm_rollouts import episodes_to_paths, evaluate_rollouts
+
+
+def load_train_args(tr_dir):
+    train_args = json.load(open(str(Path(tr_dir) / "wandb-metadata.json")))["args"]
+    return get_train_argparser().parse_args(train_args)
+
+
+def load_model(tr_dir, train_args, sample_frame, device):
+    """rebuilds the ContrastiveSWM of a training run and loads its model.pt"""
+    action_dim = gym.make(train_args.env_name).action_space.n
+    model = ContrastiveSWM(encoder=get_encoder(train_args, sample_frame),
+                           embedding_dim=train_args.slot_len,
+                           hidden_dim=train_args.hidden_dim,
+                           action_dim=action_dim,
+                           num_objects=train_args.num_slots,
+                           sigma=train_args.sigma,
+                           hinge=train_args.hinge,
+                           ignore_action=train_args.ignore_action,
+                           copy_action=train_args.copy_action,
+                           dense_transition=train_args.dense_transition)
+    model.load_state_dict(torch.load(str(Path(tr_dir) / "model.pt"), map_location=device))
+    return model.to(device)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tr-dir", type=str, default=".")
+    parser.add_argument("--run-dir", type=str, default=".")
+    parser.add_argument("--paths-h5", type=str, default=None,
+                        help="hdf5 replay buffer of paths; if not given, episodes are collected from the env")
+    parser.add_argument("--num-episodes", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--num-steps", nargs="+", type=int, default=[1, 5, 10],
+                        help="rollout lengths to evaluate")
+    parser.add_argument("--hits-at", nargs="+", type=int, default=[1, 5, 10])
+    parser.add_argument("--batch-size", type=int, default=128, help="paths encoded and rolled out at once")
+    parser.add_argument("--chunk-size", type=int, default=1024,
+                        help="predictions ranked against all targets at once")
+    parser.add_argument("--no-cuda", action="store_true", default=False)
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+
+    train_args = load_train_args(args.tr_dir)
+    path_length = max(args.num_steps)
+    if args.paths_h5 is not None:
+        dataset = PathDataset(args.paths_h5, path_length=path_length)
+    else:
+        train_args.num_episodes = args.num_episodes
+        episodes, actions, _ = get_transitions(train_args, seed=args.seed, max_episodes=args.num_episodes)
+        dataset = data.TensorDataset(*episodes_to_paths(episodes, actions, path_length))
+    print("Evaluating %i paths" % len(dataset))
+    sample_frame = torch.as_tensor(dataset[0][0][0])[None]
+    model = load_model(args.tr_dir, train_args, sample_frame, device)
+    loader = data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+
+    metrics = evaluate_rollouts(model, loader, num_steps=args.num_steps, hits_at=args.hits_at,
+                                chunk_size=args.chunk_size, device=device)
+    for k, v in sorted(metrics.items()):
+        print("%-20s %.4f" % (k, v))
+    os.makedirs(args.run_dir, exist_ok=True)
+    with open(os.path.join(args.run_dir, "cswm_rollout_metrics.json"), "w") as f:
+        json.dump(metrics, f)
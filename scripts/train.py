@@ -1,4 +1,9 @@
 import argparse
+import copy
+import json
+import shutil
+import sys
+import warnings
 import torch
 import wandb
 from src.encoders import STDIMEncoder, CSWMEncoder, SlotSTDIMEncoder
@@ -10,8 +15,15 @@ import numpy as np
 from src import cswm_utils
 import gym
 import os
-from src.data.dataloader import get_dataloaders
-from src.utils import get_num_objects, get_sample_frame
+from src.data.dataloader import get_dataloaders, rebatch, resumable
+from src.memory_model import find_batch_size, default_memory_budget
+from src.utils import get_num_objects, get_sample_frame, get_autocast, get_grad_scaler
+from src.logger import get_logger, PrefixedLogger
+from src.compilation import compile_model, export_scripted_encoder, to_channels_last
+from src.optim import get_optimizer
+from src.multi_seed import MultiSeedModel
+from src.distributed import DistributedModel, init_distributed, is_main_process, all_reduce_mean, get_world_size
+from src.checkpoint import AsyncCheckpointer, get_rng_state, set_rng_state
 
 # methods that need encoder trained before
 losses = ["hcn", "smcn", "scn", "sdl", "smdl"]
@@ -54,19 +66,22 @@ def get_argparser():
     parser.add_argument("--max-episode-steps", type=int, default=-1)
     parser.add_argument("--warmstart", type=int, default=0)
     parser.add_argument("--crop", nargs=2, type=int, default=[-1, -1])
-    parser.add_argument('--lr', type=float, default=3e-4,
-                        help='Learning Rate for learning representations (default: 5e-4)')
+    parser.add_argument('--lr', type=float, default=None,
+                        help='Learning Rate for learning representations (default: 3e-4 for adam / lamb, '
+                             '0.1 * global batch size / 256 for lars)')
     parser.add_argument('--batch-size', type=int, default=128, help='Mini-Batch Size (default: 64)')
     parser.add_argument('--epochs', type=int, default=100, help='Number of epochs for  (default: 100)')
     parser.add_argument("--wandb-proj", type=str, default="coors-scratch")
+    parser.add_argument("--log-backends", nargs="+", type=str, default=["wandb"], choices=["wandb", "jsonl", "sqlite"],
+                        help="where to write metrics; without wandb, no wandb run is started and outputs go to --run-dir")
     parser.add_argument('--num-episodes', type=int, default=10)
     parser.add_argument('--noop-max', type=int, default=30)
     parser.add_argument("--regime", type=str, default="stdim", choices=["stdim", "cswm"],
                         help="whether to use the encoder and dataloader from stdim or from cswm")
     parser.add_argument('--hidden-dim', type=int, default=512, help='Number of hidden units in transition MLP.')
     parser.add_argument('--log-interval', type=int, default=20,
-                        help='How many batches to wait before logging'
-                             'training status.')
+                        help='How many batches to wait before logging '
+                             'training status (metrics are averaged over this many batches).')
     parser.add_argument('--action-dim', type=int, default=4,
                         help='Dimensionality of action space.')
     parser.add_argument('--sigma', type=float, default=0.5,
@@ -83,33 +98,154 @@ def get_argparser():
                         help='whether to use regression for supervised')
     parser.add_argument('--random-cnn', action='store_true', default=False,
                         help='whether to not learn at all and just save random weights')
+    parser.add_argument('--concat-forward', action='store_true', default=False,
+                        help='encode xt and xtp1 with one forward pass over a concatenated 2N batch')
+    parser.add_argument('--loss-chunk-size', type=int, default=0,
+                        help='compute the N x N local contrastive losses this many rows at a time '
+                             '(peak memory linear in batch size); 0 materializes the full scores')
+    parser.add_argument('--queue-len', type=int, default=0,
+                        help='number of past slot vectors per slot kept (from a momentum encoder) as extra negatives '
+                             'for the slot time-contrastive losses; 0 disables the queue')
+    parser.add_argument('--queue-momentum', type=float, default=0.99,
+                        help='EMA coefficient of the momentum encoder that fills the negative queue')
+    parser.add_argument('--num-sampled-negatives', type=int, default=0,
+                        help='approximate the N x N slot contrastive losses by scoring each anchor against its '
+                             'positive plus this many sampled negatives; 0 uses every example in the batch')
+    parser.add_argument('--negative-sampling', type=str, default="uniform", choices=["uniform", "episode"],
+                        help='sample negatives uniformly from the batch or only from other episodes')
+    parser.add_argument('--checkpoint-segments', nargs="*", type=str, default=[],
+                        choices=["f5", "global-head", "slot-head"],
+                        help='encoder segments to recompute during backward instead of storing their activations')
+    parser.add_argument('--precision', type=str, default="fp32", choices=["fp32", "bf16", "fp16"],
+                        help='autocast the encoder forward and loss matmuls to this dtype (softmax/cross entropy '
+                             'stay in fp32); fp16 uses loss scaling and needs cuda')
+    parser.add_argument('--dense-transition', action='store_true', default=False,
+                        help='run the C-SWM transition GNN on dense (B, K, K) edge tensors with a factorized first '
+                             'edge layer instead of a gathered edge list')
+    parser.add_argument('--cswm-negatives', type=int, default=1,
+                        help='C-SWM hinge negatives per anchor: 1 draws one random in-batch negative, 0 uses '
+                             'every other example in the batch and k > 1 the k hardest (lowest energy) ones')
+    parser.add_argument('--sparse-head', action='store_true', default=False,
+                        help='supervised: only compute the (slot, state variable) predictions that are used, '
+                             'instead of every state variable for every slot')
+    parser.add_argument('--symmetric-loss', action='store_true', default=False,
+                        help='also train the t+1 -> t direction of the slot time-contrastive loss, using the '
+                             'transpose of the same logits (averaged with the t -> t+1 cross entropy)')
+    parser.add_argument('--fused-slot-head', action='store_true', default=False,
+                        help='run the weight-tied slot head as one grouped conv over f5 instead of over '
+                             'bs*num_slots reshaped slot maps (same parameters and outputs)')
+    parser.add_argument('--auto-batch-size', action='store_true', default=False,
+                        help='replace --batch-size with the largest batch size that fits --memory-budget-gb, '
+                             'from an analytic memory estimate checked by a short probing run')
+    parser.add_argument('--memory-budget-gb', type=float, default=None,
+                        help='memory budget for --auto-batch-size (default: 90%% of the gpu / half the free ram)')
+    parser.add_argument('--compile', type=str, default="none", choices=["none", "compile", "script"],
+                        help='compile the encoder and losses with torch.compile (falls back to TorchScript) or '
+                             'script the encoder, with channels_last frames and weights')
+    parser.add_argument('--optimizer', type=str, default="adam", choices=["adam", "lars", "lamb"],
+                        help='lars / lamb scale each layer\'s update by a trust ratio, for large batch training. '
+                             'lars is sgd-like and needs a much larger --lr than adam (its default is '
+                             '0.1 * batch / 256, --lr-scaling is not applied on top of it)')
+    parser.add_argument('--weight-decay', type=float, default=0.,
+                        help='weight decay (not applied to biases and norm parameters by lars / lamb)')
+    parser.add_argument('--lr-scaling', type=str, default="none", choices=["none", "linear", "sqrt"],
+                        help='scale --lr, tuned at --base-batch-size, to the actual batch size')
+    parser.add_argument('--base-batch-size', type=int, default=128,
+                        help='batch size --lr was tuned at, for --lr-scaling')
+    parser.add_argument('--lr-schedule', type=str, default="constant", choices=["constant", "warmup-cosine"],
+                        help='warmup-cosine: linear warmup over --warmup-epochs then cosine decay to 0, per step')
+    parser.add_argument('--warmup-epochs', type=float, default=5.,
+                        help='epochs of linear lr warmup for --lr-schedule warmup-cosine')
+    parser.add_argument('--num-seeds', type=int, default=1,
+                        help='train this many independently initialized copies (seeds --seed, --seed + 1, ...) on '
+                             'the same batches in one vmapped step; each is saved to <run dir>/seed_<i>')
+    parser.add_argument('--methods', nargs="+", type=str, default=None,
+                        choices=["slot-stdim", "stdim", "cswm", "random-cnn"],
+                        help='train all of these methods (instead of --method) from one shared pass over the '
+                             'data, each with its own optimizer and metrics, saved to <run dir>/<method>')
+    parser.add_argument('--dist-backend', type=str, default="gloo", choices=["gloo", "nccl"],
+                        help='process group backend when launched data parallel with torchrun (--batch-size is '
+                             'per process, the contrastive losses use the global batch as negatives)')
+    parser.add_argument('--checkpoint-interval', type=int, default=500,
+                        help='write the full training state (model, optimizer, rng, data position) to '
+                             '<checkpoint dir>/checkpoint.pt every this many training steps and after every '
+                             'epoch, from a background thread (0: off)')
+    parser.add_argument('--checkpoint-dir', type=str, default=None,
+                        help='where checkpoint.pt and a copy of the best encoder.pt live (default: --run-dir), '
+                             'should outlive the job')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='continue from <checkpoint dir>/checkpoint.pt at the exact batch it was written '
+                             'after, if it exists (e.g. when a preempted job is requeued); --methods runs '
+                             'aren\'t checkpointed and ignore it')
+    parser.add_argument('--target-loss', type=float, default=None,
+                        help='log epochs_to_target_loss, the first epoch whose average val loss is at or below this')
     return parser
 
 
-def get_device():
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    if str(device) != "cuda" and os.environ["HOME"] != '/Users/evanracah':
-        assert False, "device must be cuda!"
-    return device
+def get_device(args):
+    if torch.cuda.is_available() and not args.no_cuda:
+        # one gpu per process when launched by torchrun
+        device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+        torch.cuda.set_device(device)
+        return device
+    if not args.no_cuda and os.environ["HOME"] != '/Users/evanracah':
+        assert False, "device must be cuda! (pass --no-cuda to train on the cpu)"
+    return torch.device("cpu")
+
+
+def write_run_args(out_dir, argv, num_slots):
+    """writes the training arguments like a wandb run dir does, so scripts/eval.py --tr-dir can load local runs
+
+    the values train.py resolves itself (num_slots) are appended (the last occurrence of a flag wins when
+    parsed again), so the encoder can be rebuilt with the shapes it was trained with
+    """
+    resolved_argv = ["--num-slots", str(num_slots)]
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "wandb-metadata.json"), "w") as f:
+        json.dump(dict(args=argv + resolved_argv), f)
+
+
+def method_argv(argv, method):
+    """argv of a --methods run, as if only method had been trained with --method"""
+    method_args, skipping = [], False
+    for arg in argv:
+        if arg == "--methods":
+            skipping = True
+        elif not (skipping and not arg.startswith("-")):
+            skipping = False
+            method_args.append(arg)
+    return method_args + ["--method", method]
 
 
 def init_wandb(args):
+    """starts the wandb run (if wandb is one of the log backends) and returns the directory to save outputs to"""
+    if "wandb" not in args.log_backends:
+        write_run_args(args.run_dir, sys.argv[1:], args.num_slots)
+        return args.run_dir
     wandb.init(project=args.wandb_proj, dir=args.run_dir, tags=["train"])
     wandb.config.update(vars(args))
     with open("wandb_id.txt", "w") as f:
         f.write(str(wandb.run.id))
+    return wandb.run.dir
 
 
 def get_encoder(args, sample_frame):
     input_channels = sample_frame.shape[1]
     width_height = np.asarray(sample_frame.shape[2:])
+    # eval.py calls this with the config of older runs too, which predate --checkpoint-segments
+    checkpoint_segments = getattr(args, "checkpoint_segments", [])
     if args.method == "stdim":
         encoder = STDIMEncoder(input_channels,
-                               global_vector_len=args.num_slots*args.slot_len)
+                               global_vector_len=args.num_slots*args.slot_len,
+                               checkpoint_segments=checkpoint_segments,
+                               input_size=width_height)
     elif args.method in ["slot-stdim", "supervised", "random-cnn", "cswm"]:
         encoder = SlotSTDIMEncoder(input_channels,
                                    num_slots=args.num_slots,
-                                   slot_len=args.slot_len)
+                                   slot_len=args.slot_len,
+                                   checkpoint_segments=checkpoint_segments,
+                                   fused_slot_head=getattr(args, "fused_slot_head", False),
+                                   input_size=width_height)
     # elif args.method in ["cswm"]:
     #     encoder = CSWMEncoder(input_dim=input_channels,
     #                           hidden_dim=args.hidden_dim // 16,
@@ -121,7 +257,8 @@ def get_encoder(args, sample_frame):
 
     return encoder
 
-def get_model(encoder, args, label_keys):
+def get_model(encoder, args, label_keys, model_logger=None):
+    model_logger = logger if model_logger is None else model_logger
     if args.method == "cswm":
         action_dim = gym.make(args.env_name).action_space.n
         model = ContrastiveSWM(
@@ -133,61 +270,242 @@ def get_model(encoder, args, label_keys):
             sigma=args.sigma,
             hinge=args.hinge,
             ignore_action=args.ignore_action,
-            copy_action=args.copy_action
+            copy_action=args.copy_action,
+            concat_forward=args.concat_forward,
+            dense_transition=args.dense_transition,
+            num_negatives=args.cswm_negatives
         ).to(device)
 
         model.apply(cswm_utils.weights_init)
 
 
     elif args.method == "stdim":
-        model = STDIMModel(encoder, args, args.slot_len*args.num_slots, device, wandb).to(device)
+        model = STDIMModel(encoder, args, args.slot_len*args.num_slots, device, model_logger).to(device)
 
     elif args.method == "slot-stdim":
-        model = SlotSTDIMModel(encoder, args, device, wandb).to(device)
+        model = SlotSTDIMModel(encoder, args, device, model_logger).to(device)
 
     elif args.method == "supervised":
-        model = SupervisedModel(encoder, args, label_keys, wandb=wandb).to(device)
+        model = SupervisedModel(encoder, args, label_keys, logger=model_logger).to(device)
 
     else:
         assert False
     return model
 
 
-def do_training(model, tr_loader, val_loader):
-    optimizer = torch.optim.Adam(
-        model.parameters(),
-        lr=args.lr)
+def save_encoder(encoder, out_dir=None):
+    out_dir = save_dir if out_dir is None else out_dir
+    torch.save(encoder.state_dict(), out_dir + "/encoder.pt")
+
+
+def export_encoder(encoder, sample_frame, out_dir=None):
+    """saves the encoder.pt of out_dir as encoder_scripted.pt, a standalone TorchScript version for
+    eval/inference without the python model classes (once, after training; a failed export only warns)"""
+    out_dir = save_dir if out_dir is None else out_dir
+    try:
+        state_dict = torch.load(out_dir + "/encoder.pt", map_location="cpu")
+        export_scripted_encoder(encoder, sample_frame, out_dir + "/encoder_scripted.pt", state_dict)
+    except Exception as e:
+        warnings.warn("couldn't export {}/encoder_scripted.pt: {!r}".format(out_dir, e))
+
+
+def get_seed_dir(seed):
+    """output directory of seed: save_dir for a single model, save_dir/seed_<i> with --num-seeds"""
+    if args.num_seeds == 1:
+        return save_dir
+    out_dir = os.path.join(save_dir, "seed_%i" % seed)
+    os.makedirs(out_dir, exist_ok=True)
+    return out_dir
+
+
+def get_seed_model(model, seed):
+    """(output directory, model) of seed"""
+    if isinstance(model, DistributedModel):
+        model = model.module
+    if not isinstance(model, MultiSeedModel):
+        return get_seed_dir(seed), model
+    return get_seed_dir(seed), model.seed_model(seed)
+
+
+def copy_best(src_dir, dst_dir):
+    """copies the best encoder.pt (and cswm's model.pt) saved in src_dir to dst_dir, each file atomically"""
+    if os.path.abspath(src_dir) == os.path.abspath(dst_dir):
+        return
+    os.makedirs(dst_dir, exist_ok=True)
+    for name in ["encoder.pt", "model.pt"]:
+        if os.path.exists(os.path.join(src_dir, name)):
+            dst_path = os.path.join(dst_dir, name)
+            shutil.copyfile(os.path.join(src_dir, name), dst_path + ".tmp")
+            os.replace(dst_path + ".tmp", dst_path)
+
+
+def get_multi_seed_model(args, label_keys, sample_frame):
+    """--num-seeds copies of get_model, initialized with seeds --seed, --seed + 1, ..., stacked into one
+    MultiSeedModel"""
+    assert args.method != "random-cnn", "random-cnn isn't trained, run it once per seed instead"
+    assert args.optimizer == "adam", "lars / lamb trust ratios would be computed over all seeds at once"
+    # these keep python-side state or use autograd features that can't run under vmap
+    assert args.queue_len == 0 and args.loss_chunk_size == 0 and not args.checkpoint_segments, \
+        "--num-seeds doesn't support --queue-len, --loss-chunk-size or --checkpoint-segments"
+    assert args.compile == "none" and not args.auto_batch_size, \
+        "--num-seeds doesn't support --compile or --auto-batch-size"
+    models = []
+    for seed in range(args.num_seeds):
+        torch.manual_seed(args.seed + seed)
+        models.append(get_model(get_encoder(args, sample_frame), args, label_keys))
+    return MultiSeedModel(models, logger=logger)
+
+
+def get_data_order():
+    """what the batches of an epoch depend on, a resumed run has to match it to pick up at the same batch"""
+    return dict(seed=args.seed, batch_size=args.batch_size, world_size=get_world_size())
+
+
+def get_checkpoint_path(args):
+    # not in the wandb run dir: a restarted job gets a new wandb run
+    checkpoint_dir = args.run_dir if args.checkpoint_dir is None else args.checkpoint_dir
+    return os.path.join(checkpoint_dir, "checkpoint.pt")
+
+
+def get_resumed_batch_size(args):
+    """the batch size of the checkpoint --resume will continue from, None if there is nothing to resume"""
+    checkpoint_path = get_checkpoint_path(args)
+    if not (args.resume and os.path.exists(checkpoint_path)):
+        return None
+    return torch.load(checkpoint_path, map_location="cpu", weights_only=False)["data_order"]["batch_size"]
+
+
+def save_training_state(checkpointer, model, optimizer, scheduler, scaler, progress):
+    checkpointer.save(dict(model=model.state_dict(),
+                           optimizer=optimizer.state_dict(),
+                           scheduler=None if scheduler is None else scheduler.state_dict(),
+                           scaler=scaler.state_dict(),
+                           progress=progress,
+                           rng=get_rng_state(),
+                           logger_step=logger.num_steps,
+                           data_order=get_data_order()))
+
+
+def load_training_state(path, model, optimizer, scheduler, scaler):
+    """restores everything save_training_state saved and returns the saved progress"""
+    state = torch.load(path, map_location="cpu", weights_only=False)
+    assert state["data_order"] == get_data_order(), \
+        "can't resume with a different data order: {} vs {}".format(state["data_order"], get_data_order())
+    model.load_state_dict(state["model"])
+    optimizer.load_state_dict(state["optimizer"])
+    if scheduler is not None:
+        scheduler.load_state_dict(state["scheduler"])
+    scaler.load_state_dict(state["scaler"])
+    set_rng_state(state["rng"])
+    logger.num_steps = state["logger_step"]
+    return state["progress"]
+
+
+def do_training(model, tr_loader, val_loader, sample_frame):
+    """trains model; tr_loader and val_loader need a ResumableSampler (see src.data.dataloader.resumable)"""
+    optimizer, scheduler = get_optimizer(model.parameters(), args, steps_per_epoch=len(tr_loader))
+
+    scaler = get_grad_scaler(device, args.precision)
+
+    # the epoch we are in, the next training batch of it and the sum of its training losses so far
+    # best_losses: the best average val loss of every seed (one entry without --num-seeds)
+    progress = dict(epoch=0, batch=0, tr_loss_sum=0., best_losses=[1e9] * args.num_seeds, reached_target=False)
+    checkpoint_path = get_checkpoint_path(args)
+    checkpoint_dir = os.path.dirname(checkpoint_path)
+    # the best encoders so far are kept next to checkpoint.pt too, since a restarted job starts with an
+    # empty run dir but restores progress["best_losses"]
+    best_dirs = [os.path.join(checkpoint_dir, os.path.relpath(get_seed_dir(seed), save_dir))
+                 for seed in range(args.num_seeds)] if is_main_process() else []
+    if args.resume and os.path.exists(checkpoint_path):
+        progress = load_training_state(checkpoint_path, model, optimizer, scheduler, scaler)
+        print('Resuming from epoch {} batch {}'.format(progress["epoch"] + 1, progress["batch"]))
+        for seed, best_dir in enumerate(best_dirs):
+            copy_best(best_dir, get_seed_dir(seed))
+    checkpointer = None
+    if args.checkpoint_interval > 0 and is_main_process():
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpointer = AsyncCheckpointer(checkpoint_path)
+
+    def checkpoint(epoch, batch, tr_loss_sum, force=False):
+        step = epoch * len(tr_loader) + batch
+        if checkpointer is not None and (force or step % args.checkpoint_interval == 0):
+            progress.update(epoch=epoch, batch=batch, tr_loss_sum=float(tr_loss_sum))
+            save_training_state(checkpointer, model, optimizer, scheduler, scaler, dict(progress))
 
     print('Starting model training...')
-    best_loss = 1e9
-
-    for epoch in range(args.epochs):
+    for epoch in range(progress["epoch"], args.epochs):
+        start_batch = progress["batch"] if epoch == progress["epoch"] else 0
+        tr_loss_sum = progress["tr_loss_sum"] if epoch == progress["epoch"] else 0.
+        # fast-forward to the first batch we haven't trained on, without loading the ones before it
+        tr_loader.sampler.set_epoch(epoch, start=start_batch * tr_loader.batch_size)
+        val_loader.sampler.set_epoch(epoch)
         model.train()
-        tr_loss = do_epoch(tr_loader, optimizer, model, epoch)
+        tr_loss, _ = do_epoch(tr_loader, optimizer, model, epoch, scaler, scheduler, start_batch, tr_loss_sum,
+                              checkpoint_fn=lambda batch, loss_sum: checkpoint(epoch, batch, loss_sum))
         print('====> Epoch: {} Train average loss: {:.6f}'.format(
             epoch + 1, tr_loss))
 
         model.eval()
-        val_loss = do_epoch(val_loader, optimizer, model, epoch)
+        val_loss, seed_val_losses = do_epoch(val_loader, optimizer, model, epoch, scaler)
         print('====> \t Val average loss: {:.6f}'.format(
             val_loss))
-        if val_loss < best_loss:
-            best_loss = val_loss
-            torch.save(model.encoder.state_dict(), wandb.run.dir + "/encoder.pt")
-
-
-def do_epoch(loader, optimizer, model, epoch):
-    total_loss = 0.
-    for batch_idx, data_batch in enumerate(loader):
+        if args.target_loss is not None and not progress["reached_target"] and val_loss <= args.target_loss:
+            progress["reached_target"] = True
+            print('====> \t Reached target loss {} after {} epochs'.format(args.target_loss, epoch + 1))
+            logger.log(dict(epochs_to_target_loss=epoch + 1))
+            logger.flush()
+        # the other processes of a data parallel run hold the same weights
+        for seed, seed_val_loss in enumerate(seed_val_losses):
+            # every seed keeps its own best, like a separate run would
+            if seed_val_loss < progress["best_losses"][seed] and is_main_process():
+                progress["best_losses"][seed] = seed_val_loss
+                out_dir, seed_model = get_seed_model(model, seed)
+                save_encoder(seed_model.encoder, out_dir)
+                if args.method == "cswm":
+                    # the transition model too, for the rollout evaluation in scripts/eval_cswm.py
+                    torch.save(seed_model.state_dict(), out_dir + "/model.pt")
+                if checkpointer is not None:
+                    copy_best(out_dir, best_dirs[seed])
+        # a finished epoch (validation included) is never redone
+        checkpoint(epoch + 1, 0, 0., force=True)
+
+    if checkpointer is not None:
+        checkpointer.close()
+    if is_main_process():
+        for seed in range(args.num_seeds):
+            out_dir, seed_model = get_seed_model(model, seed)
+            export_encoder(seed_model.encoder, sample_frame, out_dir)
+
+
+def do_epoch(loader, optimizer, model, epoch, scaler, scheduler=None, start_batch=0, total_loss=0.,
+             checkpoint_fn=None):
+    """one pass over loader (training if model.training)
+
+    start_batch and total_loss resume an epoch part way through (the loader's sampler already skips the
+    first start_batch batches); checkpoint_fn(batches done, loss sum so far) is called after every training step
+
+    Returns:
+        the average loss and the list of per-seed average losses of a MultiSeedModel ([average loss] for
+        any other model; for a resumed epoch they only cover the batches since start_batch)
+    """
+    seed_loss_sums = 0.
+    for batch_idx, data_batch in enumerate(loader, start=start_batch):
         data_batch = [tensor.to(device) for tensor in data_batch]
+        if args.compile != "none":
+            data_batch = [to_channels_last(tensor) for tensor in data_batch]
         optimizer.zero_grad()
 
-        loss = model.calc_loss(*data_batch)
+        with get_autocast(device, args.precision):
+            loss = model.calc_loss(*data_batch)
 
         if model.training:
-            wandb.log(dict(tr_loss=loss))
-            loss.backward()
-            optimizer.step()
+            logger.log(dict(tr_loss=loss))
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            if scheduler is not None:
+                logger.log(dict(lr=scheduler.get_last_lr()[0]))
+                scheduler.step()
             if batch_idx % args.log_interval == 0:
                 print(
                     'Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
@@ -197,31 +515,188 @@ def do_epoch(loader, optimizer, model, epoch):
                                loss.item() / len(data_batch[0])))
 
         else:
-            wandb.log(dict(val_loss=loss))
-
-        total_loss += loss.item()
-
-    avg_loss = total_loss / len(loader.dataset)
-    return avg_loss
+            logger.log(dict(val_loss=loss))
+
+        logger.step()
+        # accumulate on the device, so there is no host sync per batch
+        total_loss += loss.detach()
+        if isinstance(model, MultiSeedModel):
+            seed_loss_sums += model.last_losses
+        if model.training and checkpoint_fn is not None:
+            checkpoint_fn(batch_idx + 1, total_loss)
+
+    logger.flush()
+    # len(sampler) is this process's share of the dataset when training data parallel
+    avg_loss = all_reduce_mean(float(total_loss) / len(loader.sampler))
+    if isinstance(model, MultiSeedModel):
+        return avg_loss, (seed_loss_sums / len(loader.sampler)).tolist()
+    return avg_loss, [avg_loss]
+
+
+def get_multi_method_models(args, label_keys, sample_frame):
+    """{method: model} for every method in --methods, each logging under its own "<method>/" namespace"""
+    assert args.num_seeds == 1 and not args.auto_batch_size, "--methods doesn't support --num-seeds or --auto-batch-size"
+    if args.resume:
+        # the cluster scripts always pass --resume
+        warnings.warn("--methods runs aren't checkpointed, ignoring --resume")
+    models = {}
+    for method in args.methods:
+        method_args = copy.copy(args)
+        method_args.method = method
+        encoder = get_encoder(method_args, sample_frame)
+        if method == "random-cnn":
+            models[method] = encoder.to(device)
+        else:
+            models[method] = get_model(encoder, method_args, label_keys, PrefixedLogger(logger, method))
+    return models
+
+
+def do_multi_training(models, tr_loader, val_loader, sample_frame):
+    """trains every model of {method: model} on the same batches, so data loading and the host to device copy
+    happen once per batch for all of them; each has its own optimizer, best checkpoint (<run dir>/<method>)
+    and metrics"""
+    trainers = {}
+    for method, model in models.items():
+        out_dir = os.path.join(save_dir, method)
+        # each method dir can be evaluated on its own with scripts/eval.py --tr-dir <run dir>/<method>
+        write_run_args(out_dir, method_argv(sys.argv[1:], method), args.num_slots)
+        if method == "random-cnn":
+            save_encoder(model, out_dir)
+            export_encoder(model, sample_frame, out_dir)
+            continue
+        optimizer, scheduler = get_optimizer(model.parameters(), args, steps_per_epoch=len(tr_loader))
+        trainers[method] = dict(model=model, optimizer=optimizer, scheduler=scheduler,
+                                scaler=get_grad_scaler(device, args.precision), logger=PrefixedLogger(logger, method),
+                                out_dir=out_dir, best_loss=1e9, reached_target=False)
 
+    print('Starting model training...')
+    for epoch in range(args.epochs):
+        tr_losses = do_multi_epoch(tr_loader, trainers, epoch, train=True)
+        val_losses = do_multi_epoch(val_loader, trainers, epoch, train=False)
+        for method, trainer in trainers.items():
+            tr_loss, val_loss = tr_losses[method], val_losses[method]
+            print('====> Epoch: {} {} Train average loss: {:.6f} \t Val average loss: {:.6f}'.format(
+                epoch + 1, method, tr_loss, val_loss))
+            if args.target_loss is not None and not trainer["reached_target"] and val_loss <= args.target_loss:
+                trainer["reached_target"] = True
+                trainer["logger"].log(dict(epochs_to_target_loss=epoch + 1))
+            if val_loss < trainer["best_loss"]:
+                trainer["best_loss"] = val_loss
+                model = trainer["model"]
+                save_encoder(model.encoder, trainer["out_dir"])
+                if method == "cswm":
+                    torch.save(model.state_dict(), trainer["out_dir"] + "/model.pt")
+        logger.flush()
+
+    for trainer in trainers.values():
+        export_encoder(trainer["model"].encoder, sample_frame, trainer["out_dir"])
+
+
+def do_multi_epoch(loader, trainers, epoch, train=True):
+    """one pass over loader for all trainers (see do_multi_training), returns {method: average loss}"""
+    total_losses = {method: 0. for method in trainers}
+    for trainer in trainers.values():
+        trainer["model"].train(train)
+    for batch_idx, data_batch in enumerate(loader):
+        data_batch = [tensor.to(device) for tensor in data_batch]
+        if args.compile != "none":
+            data_batch = [to_channels_last(tensor) for tensor in data_batch]
+
+        for method, trainer in trainers.items():
+            model, optimizer, scaler = trainer["model"], trainer["optimizer"], trainer["scaler"]
+            # only slot-stdim uses the episode ids of --negative-sampling episode
+            batch = data_batch if method == "slot-stdim" else data_batch[:3]
+            optimizer.zero_grad()
+            with get_autocast(device, args.precision):
+                loss = model.calc_loss(*batch)
+
+            if train:
+                trainer["logger"].log(dict(tr_loss=loss))
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                if trainer["scheduler"] is not None:
+                    trainer["logger"].log(dict(lr=trainer["scheduler"].get_last_lr()[0]))
+                    trainer["scheduler"].step()
+            else:
+                trainer["logger"].log(dict(val_loss=loss))
+            total_losses[method] += loss.detach()
+
+        if train and batch_idx % args.log_interval == 0:
+            print('Epoch: {} [{}/{} ({:.0f}%)]'.format(epoch, batch_idx * len(data_batch[0]), len(loader.dataset),
+                                                       100. * batch_idx / len(loader)))
+        logger.step()
+
+    logger.flush()
+    return {method: float(total_loss) / len(loader.dataset) for method, total_loss in total_losses.items()}
 
 
 if __name__ == "__main__":
     args = get_args()
-    device = get_device()
-
+    rank, world_size = init_distributed(args.dist_backend)
+    device = get_device(args)
+    assert world_size == 1 or (args.num_seeds == 1 and args.methods is None and not args.auto_batch_size), \
+        "--num-seeds, --methods and --auto-batch-size can't be used data parallel"
+    # sampled negatives and blocked InfoNCE index the local batch only
+    assert world_size == 1 or (args.num_sampled_negatives == 0 and args.loss_chunk_size == 0), \
+        "--num-sampled-negatives and --loss-chunk-size can't be trained data parallel"
+
+    episode_negatives = args.num_sampled_negatives > 0 and args.negative_sampling == "episode"
+    assert not episode_negatives or args.method == "slot-stdim" or "slot-stdim" in (args.methods or []), \
+        "only slot-stdim samples negatives by episode"
     (tr_dl, val_dl), label_keys = get_dataloaders(args,
-                                                  keep_as_episodes=(args.method != "supervised"),
+                                                  keep_as_episodes=(args.methods is not None
+                                                                    or args.method != "supervised"),
                                                   test_set=False,
-                                                  label_keys=True)
+                                                  label_keys=True,
+                                                  return_episode_ids=episode_negatives)
     num_objects = get_num_objects(label_keys)
     args.num_slots = num_objects  # we cheat a lil bit here!
-    init_wandb(args)
+    if is_main_process():
+        save_dir = init_wandb(args)
+        logger = get_logger(args.log_backends, save_dir, interval=args.log_interval, wandb=wandb)
+    else:
+        # only rank 0 logs and saves
+        save_dir = None
+        logger = get_logger([], None, interval=args.log_interval)
 
     sample_frame = get_sample_frame(tr_dl)
-    encoder = get_encoder(args, sample_frame)
-    if args.method == "random-cnn":
-        torch.save(encoder.state_dict(), wandb.run.dir + "/encoder.pt")
+    if args.methods is not None:
+        models = get_multi_method_models(args, label_keys, sample_frame)
+        for method, model in models.items():
+            if method != "random-cnn":
+                compile_model(model, args.compile)
+        do_multi_training(models, tr_dl, val_dl, sample_frame)
+    elif args.method == "random-cnn":
+        if is_main_process():
+            encoder = get_encoder(args, sample_frame)
+            save_encoder(encoder)
+            export_encoder(encoder, sample_frame)
     else:
-        model = get_model(encoder, args, label_keys)
-        do_training(model, tr_dl, val_dl)
+        if args.num_seeds > 1:
+            model = get_multi_seed_model(args, label_keys, sample_frame)
+        else:
+            model = get_model(get_encoder(args, sample_frame), args, label_keys)
+        if args.auto_batch_size:
+            assert args.method != "supervised", "--auto-batch-size is for the contrastive methods"
+            resumed_batch_size = get_resumed_batch_size(args)
+            if resumed_batch_size is not None:
+                # probing again on a requeued job can pick a different size, which can't resume the data order
+                args.batch_size = resumed_batch_size
+                print("auto batch size: %i (from the checkpoint being resumed)" % args.batch_size)
+            else:
+                budget = (default_memory_budget(device) if args.memory_budget_gb is None
+                          else args.memory_budget_gb * 2**30)
+                args.batch_size, estimate, measured = find_batch_size(model, args, sample_frame, device, budget)
+                print("auto batch size: %i (estimated peak %.2f GB, measured %.2f GB, budget %.2f GB)"
+                      % (args.batch_size, estimate / 2**30, measured / 2**30, budget / 2**30))
+                logger.log(dict(auto_batch_size=args.batch_size, estimated_peak_gb=estimate / 2**30,
+                                measured_peak_gb=measured / 2**30, memory_budget_gb=budget / 2**30))
+                logger.flush()
+            tr_dl, val_dl = rebatch(tr_dl, args.batch_size), rebatch(val_dl, args.batch_size)
+        compile_model(model, args.compile)
+        if world_size > 1:
+            model = DistributedModel(model)
+        tr_dl, val_dl = resumable(tr_dl, args.seed, rank, world_size), resumable(val_dl, args.seed, rank, world_size)
+        do_training(model, tr_dl, val_dl, sample_frame)
+    logger.close()
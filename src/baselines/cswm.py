@@ -1,9 +1,11 @@
 import src.cswm_utils as utils
+from src.encoders import encode_pair
 
 import numpy as np
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 
 class ContrastiveSWM(nn.Module):
     """Main module for a Contrastively-trained Structured World Model (C-SWM).
@@ -18,7 +20,9 @@ class ContrastiveSWM(nn.Module):
 
     def __init__(self, encoder, embedding_dim, hidden_dim, action_dim,
                  num_objects, hinge=1., sigma=0.5,
-                 ignore_action=False, copy_action=False):
+                 ignore_action=False, copy_action=False,
+                 concat_forward=False, dense_transition=False,
+                 num_negatives=1):
         super(ContrastiveSWM, self).__init__()
 
         self.encoder = encoder
@@ -30,6 +34,8 @@ class ContrastiveSWM(nn.Module):
         self.sigma = sigma
         self.ignore_action = ignore_action
         self.copy_action = copy_action
+        self.concat_forward = concat_forward
+        self.num_negatives = num_negatives
 
         self.pos_loss = 0
         self.neg_loss = 0
@@ -43,7 +49,8 @@ class ContrastiveSWM(nn.Module):
             action_dim=action_dim,
             num_objects=num_objects,
             ignore_action=ignore_action,
-            copy_action=copy_action)
+            copy_action=copy_action,
+            dense=dense_transition)
 
         # self.width = width_height[0]
         # self.height = width_height[1]
@@ -59,28 +66,51 @@ class ContrastiveSWM(nn.Module):
             pred_trans = self.transition_model(state, action)
             diff = state + pred_trans - next_state
 
-        return norm * diff.pow(2).sum(2).mean(1)
+        return norm * diff.float().pow(2).sum(2).mean(1)
 
-    def transition_loss(self, state, action, next_state):
-        return self.energy(state, action, next_state).mean()
+    def pairwise_energy(self, state, other_state):
+        """[N, M] no_trans energies between every state and every other_state.
 
-    def calc_loss(self, obs, action, next_obs):
+        energy(no_trans=True) is norm * the squared distance summed over embedding dims and averaged over
+        objects, i.e. norm / num_objects * the squared distance of the flattened states, so all pairs come
+        from one matmul based distance matrix."""
+        norm = 0.5 / (self.sigma ** 2)
+        dist = utils.pairwise_distance_matrix(state.flatten(1).float(), other_state.flatten(1).float())
+        return norm * dist / state.size(1)
 
-        state = self.encoder(obs)
-        next_state = self.encoder(next_obs)
+    def negative_loss(self, state):
+        """Hinge loss on the energies of negative pairs drawn from the batch.
 
-        # Sample negative state across episodes at random
+        num_negatives == 1: one random other example per anchor (the original C-SWM loss)
+        num_negatives == 0: every other example in the batch
+        num_negatives == k > 1: the k hardest (lowest energy) other examples
+        """
         batch_size = state.size(0)
-        perm = np.random.permutation(batch_size)
-        neg_state = state[perm]
+        if self.num_negatives == 1:
+            # Sample negative state across episodes at random (on the device, no host round trip)
+            perm = torch.randperm(batch_size, device=state.device)
+            neg_energy = self.energy(state, None, state[perm], no_trans=True)
+            return torch.relu(self.hinge - neg_energy).mean()
+
+        energies = self.pairwise_energy(state, state)  # [N, N]
+        is_self = torch.eye(batch_size, dtype=torch.bool, device=state.device)
+        if self.num_negatives == 0:
+            hinge = torch.relu(self.hinge - energies).masked_fill(is_self, 0)
+            return (hinge.sum(1) / (batch_size - 1)).mean()
+
+        k = min(self.num_negatives, batch_size - 1)
+        hardest = energies.masked_fill(is_self, float("inf")).topk(k, dim=1, largest=False).values
+        return torch.relu(self.hinge - hardest).mean()
 
-        self.pos_loss = self.energy(state, action, next_state)
-        zeros = torch.zeros_like(self.pos_loss)
+    def transition_loss(self, state, action, next_state):
+        return self.energy(state, action, next_state).mean()
 
-        self.pos_loss = self.pos_loss.mean()
-        self.neg_loss = torch.max(
-            zeros, self.hinge - self.energy(
-                state, action, neg_state, no_trans=True)).mean()
+    def calc_loss(self, obs, action, next_obs):
+
+        state, next_state = encode_pair(self.encoder, obs, next_obs, concat=self.concat_forward)
+
+        self.pos_loss = self.energy(state, action, next_state).mean()
+        self.neg_loss = self.negative_loss(state)
 
         loss = self.pos_loss + self.neg_loss
 
@@ -91,10 +121,15 @@ class ContrastiveSWM(nn.Module):
 
 
 class TransitionGNN(torch.nn.Module):
-    """GNN-based transition function."""
+    """GNN-based transition function.
+
+    Args:
+        dense: compute the fully connected message passing on dense (B, K, K, hidden_dim) edge tensors
+               instead of gathering and scatter-adding an explicit edge list (see _dense_forward)
+    """
 
     def __init__(self, input_dim, hidden_dim, action_dim, num_objects,
-                 ignore_action=False, copy_action=False, act_fn='relu'):
+                 ignore_action=False, copy_action=False, act_fn='relu', dense=False):
         super(TransitionGNN, self).__init__()
 
         self.input_dim = input_dim
@@ -126,8 +161,10 @@ class TransitionGNN(torch.nn.Module):
             utils.get_act_fn(act_fn),
             nn.Linear(hidden_dim, input_dim))
 
+        self.dense = dense
         self.edge_list = None
         self.batch_size = 0
+        self.edge_list_device = None
 
     def _edge_model(self, source, target, edge_attr):
         del edge_attr  # Unused.
@@ -144,10 +181,11 @@ class TransitionGNN(torch.nn.Module):
             out = node_attr
         return self.node_mlp(out)
 
-    def _get_edge_list_fully_connected(self, batch_size, num_objects, cuda):
-        # Only re-evaluate if necessary (e.g. if batch size changed).
-        if self.edge_list is None or self.batch_size != batch_size:
+    def _get_edge_list_fully_connected(self, batch_size, num_objects, device):
+        # Only re-evaluate if necessary (e.g. if batch size or device changed).
+        if self.edge_list is None or self.batch_size != batch_size or self.edge_list_device != device:
             self.batch_size = batch_size
+            self.edge_list_device = device
 
             # Create fully-connected adjacency matrix for single sample.
             adj_full = torch.ones(num_objects, num_objects)
@@ -165,16 +203,55 @@ class TransitionGNN(torch.nn.Module):
             self.edge_list += offset.unsqueeze(-1)
 
             # Transpose to COO format -> Shape: [2, num_edges].
-            self.edge_list = self.edge_list.transpose(0, 1)
-
-            if cuda:
-                self.edge_list = self.edge_list.cuda()
+            self.edge_list = self.edge_list.transpose(0, 1).to(device)
 
         return self.edge_list
 
+    def _dense_forward(self, states, action):
+        """same result as the edge list path, without materializing per-edge inputs
+
+        The first edge layer is linear in cat([source, target]), so it splits into a source half and a target
+        half that are applied once per node (O(B*K) instead of O(B*K*(K-1))) and broadcast-added into the
+        (B, K, K, hidden_dim) edge pre-activations. The rest of the edge MLP runs on that dense tensor, the
+        diagonal (self edges) is masked out and the messages are summed over the target axis, which is
+        exactly what unsorted_segment_sum does over the source node ids of the edge list.
+
+        The node MLP's first layer is split the same way. A one-hot action times its action columns is just
+        one column of the weight, so the action term is an embedding lookup into the transposed weight.
+        """
+        batch_size, num_nodes, _ = states.shape
+        first_edge_layer, first_node_layer = self.edge_mlp[0], self.node_mlp[0]
+        D, A = self.input_dim, self.action_dim
+
+        # node_mlp input layout: [states (D), action one-hot (A), aggregated messages (hidden_dim)]
+        node_pre = F.linear(states, first_node_layer.weight[:, :D], first_node_layer.bias)
+
+        if num_nodes > 1:
+            source = F.linear(states, first_edge_layer.weight[:, :D], first_edge_layer.bias)  # (B, K, H)
+            target = F.linear(states, first_edge_layer.weight[:, D:])  # (B, K, H)
+            edge_attr = self.edge_mlp[1:](source[:, :, None] + target[:, None, :])  # (B, K, K, H)
+            not_self = 1 - torch.eye(num_nodes, dtype=edge_attr.dtype, device=edge_attr.device)
+            agg = (edge_attr * not_self[:, :, None]).sum(2)  # (B, K, H)
+            node_pre = node_pre + F.linear(agg, first_node_layer.weight[:, D + A:])
+
+        if not self.ignore_action:
+            action_table = first_node_layer.weight[:, D:D + A].t()  # (A, H): row a = W @ one_hot(a)
+            if self.copy_action:
+                node_pre = node_pre + F.embedding(action, action_table)[:, None]
+            else:
+                # one-hot over action_dim * num_nodes: node action // A gets action % A, the other nodes nothing
+                action_term = F.embedding(action % A, action_table)  # (B, H)
+                nodes = torch.arange(num_nodes, device=action.device)
+                on_node = (nodes[None, :] == (action // A)[:, None]).to(action_term.dtype)  # (B, K)
+                node_pre = node_pre + on_node[:, :, None] * action_term[:, None]
+
+        return self.node_mlp[1:](node_pre)
+
     def forward(self, states, action):
 
-        cuda = states.is_cuda
+        if self.dense:
+            return self._dense_forward(states, action)
+
         batch_size = states.size(0)
         num_nodes = states.size(1)
 
@@ -188,7 +265,7 @@ class TransitionGNN(torch.nn.Module):
         if num_nodes > 1:
             # edge_index: [B * (num_objects*[num_objects-1]), 2] edge list
             edge_index = self._get_edge_list_fully_connected(
-                batch_size, num_nodes, cuda)
+                batch_size, num_nodes, states.device)
 
             row, col = edge_index
             edge_attr = self._edge_model(
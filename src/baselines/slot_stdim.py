@@ -1,28 +1,36 @@
 import torch.nn as nn
 import torch
+from src.encoders import encode_pair
+from src.running_metrics import diagonal_target, contrastive_accuracy
+from src.contrastive import blocked_info_nce, SlotNegativeQueue, sample_negatives, sampled_logits, sampled_info_nce
+from src.distributed import gather_batch, offset_target, is_distributed
 
 class SlotSTDIMModel(nn.Module):
-    def __init__(self, encoder, args, device, wandb=None):
+    def __init__(self, encoder, args, device, logger=None):
         super().__init__()
         self.args = args
         self.losses_to_use = self.args.losses
         self.encoder = encoder
         self.device = device
-        self.wandb = wandb
+        self.logger = logger
         self.local_len = self.encoder.feat_maps_per_slot_map
         self.global_len = self.encoder.slot_len
         self.project_to_slot_len = nn.Linear(self.local_len, self.global_len)
         self.project_local_len_to_local_len = nn.Linear(self.local_len, self.local_len)
         self.project_slot_len_slot_len = nn.Linear(self.global_len, self.global_len)
+        self.negative_queue = None
+        if self.args.queue_len > 0:
+            self.negative_queue = SlotNegativeQueue(encoder, self.encoder.num_slots, self.global_len,
+                                                    self.args.queue_len, self.args.queue_momentum)
 
 
     def log(self, name, scalar):
         if self.training:
-            self.wandb.log({"tr_"+ name: scalar})
+            self.logger.log({"tr_"+ name: scalar})
         else:
-            self.wandb.log({"val_"+ name: scalar})
+            self.logger.log({"val_"+ name: scalar})
 
-    def calc_loss(self, xt, a, xtp1):
+    def calc_loss(self, xt, a, xtp1, episode_ids=None):
         """ Compute loss slot-stdim loss and log it.
 
         Arguments:
@@ -32,64 +40,108 @@ class SlotSTDIMModel(nn.Module):
                                     size (batch_size,)
             xtp1 (torch.FloatTensor) -- batch of frames one time step later (t+1) than each frame in xt
                                         size: (batch_size, 3, height, width)
+            episode_ids (torch.LongTensor) -- episode index of each example, only used to sample negatives
+                                              from other episodes (--negative-sampling episode)
+                                              size (batch_size,)
 
         Returns:
             loss (torch.Float) -- the overall loss for current batch of xt and xtp1
         """
-        sv_t, sv_tp1 = self.encoder(xt), self.encoder(xtp1)
-        sm_t, sm_tp1 = self.encoder.get_slot_maps(xt), self.encoder.get_slot_maps(xtp1)
+        # one pass through the conv trunk per input gives us both the slot maps and the slot vectors
+        out_t, out_tp1 = encode_pair(self.encoder, xt, xtp1,
+                                     fn=self.encoder.get_intermediates,
+                                     concat=self.args.concat_forward)
+        sv_t, sv_tp1 = out_t["slots"], out_tp1["slots"]
+        sm_t, sm_tp1 = out_t["slot_maps"], out_tp1["slot_maps"]
+        shared = self.calc_shared_inputs(sv_t, sm_t, sm_tp1)
+
+        # with --num-sampled-negatives, the N x N losses score each anchor against the same sampled negatives
+        negatives = None
+        if self.args.num_sampled_negatives > 0:
+            negatives = sample_negatives(xt.shape[0], self.args.num_sampled_negatives, xt.device, episode_ids)
 
         loss = 0.0
         if "hcn" in self.losses_to_use:
-            loss_gl, acc_gl = self.calc_slot_global_to_local_loss(sv_t, sm_tp1)
+            loss_gl, acc_gl = self.calc_slot_global_to_local_loss(sv_t, shared["sm_tp1_slot_major"], negatives)
             loss += loss_gl
 
             for k, v in dict(loss_gl=loss_gl, acc_gl=acc_gl).items():
                 self.log(k, v)
 
         if "smcn" in self.losses_to_use:
-            loss_ll, acc_ll = self.calc_slot_local_to_local_loss(sm_t, sm_tp1)
+            loss_ll, acc_ll = self.calc_slot_local_to_local_loss(shared["proj_sm_t"], shared["sm_tp1_slot_major"],
+                                                                 negatives)
             loss += loss_ll
 
             for k, v in dict(loss_ll=loss_ll, acc_ll=acc_ll).items():
                 self.log(k, v)
 
         if "scn" in self.losses_to_use:
-            loss_sv, acc_sv = self.calc_slot_global_to_global_loss(sv_t, sv_tp1)
+            loss_sv, acc_sv = self.calc_slot_global_to_global_loss(shared["proj_sv_t"], sv_tp1, negatives)
             loss += loss_sv
 
             for k, v in dict(loss_sv=loss_sv, acc_sv=acc_sv).items():
                 self.log(k, v)
 
         if "sdl" in self.losses_to_use:
-            loss_ss, acc_ss = self.calc_slot_diversity_loss_in_slot_space(sv_t, sv_tp1)
+            loss_ss, acc_ss = self.calc_slot_diversity_loss_in_slot_space(shared["proj_sv_t"], sv_tp1)
             loss += loss_ss
 
             for k, v in dict(loss_ss=loss_ss, acc_ss=acc_ss).items():
                 self.log(k, v)
 
         if "smdl" in self.losses_to_use:
-            loss_sm, acc_sm = self.calc_slot_diversity_loss_in_local_fmap_space(sm_t, sm_tp1)
+            loss_sm, acc_sm = self.calc_slot_diversity_loss_in_local_fmap_space(shared["proj_sm_t"], sm_tp1)
             loss += loss_sm
 
             for k, v in dict(loss_sm=loss_sm, acc_ss=acc_sm).items():
                 self.log(k, v)
 
+        if self.negative_queue is not None and self.training:
+            self.negative_queue.update(self.encoder, xtp1)
 
         return loss
 
+    def calc_shared_inputs(self, sv_t, sm_t, sm_tp1):
+        """computes every projection and layout transform used by more than one of the active losses, once
 
-    def calc_slot_global_to_global_loss(self, slot_vectors1, slot_vectors2):
+        Arguments:
+            sv_t (torch.FloatTensor) -- slot vectors at t, size (N, num_slots, slot_len)
+            sm_t, sm_tp1 (torch.FloatTensor) -- slot maps at t and t+1,
+                                                size (N, num_slots, num_feat_maps_per_slot, h, w)
+
+        Returns:
+            dict with (only the entries the active losses need)
+                "proj_sv_t": project_slot_len_slot_len(sv_t), (N, num_slots, slot_len)           -- scn, sdl
+                "proj_sm_t": project_local_len_to_local_len of sm_t with the depth innermost,
+                             (N, h, w, num_slots, num_feat_maps_per_slot)                         -- smcn, smdl
+                "sm_tp1_slot_major": sm_tp1 laid out as (num_slots, h, w, N, num_feat_maps_per_slot)  -- hcn, smcn
+        """
+        losses = set(self.losses_to_use)
+        shared = {}
+        if losses & {"scn", "sdl"}:
+            shared["proj_sv_t"] = self.project_slot_len_slot_len(sv_t)
+        if losses & {"smcn", "smdl"}:
+            # the projection acts on the depth only, so projecting once and permuting the result
+            # gives each loss exactly what projecting its own layout would have
+            shared["proj_sm_t"] = self.project_local_len_to_local_len(sm_t.permute(0, 3, 4, 1, 2))
+        if losses & {"hcn", "smcn"}:
+            shared["sm_tp1_slot_major"] = sm_tp1.permute(1, 3, 4, 0, 2)
+        return shared
+
+    def calc_slot_global_to_global_loss(self, slot_vectors1, slot_vectors2, negatives=None):
         """ oss 1: Does a pair of slot vectors from the same slot
                    come from consecutive (or within a small window) time steps or not?
 
             Arguments:
-                slot_vectors1 (torch.FloatTensor) --  a batch of outputs from the slot encoder
+                slot_vectors1 (torch.FloatTensor) --  a batch of outputs from the slot encoder,
+                                             already passed through project_slot_len_slot_len
                                              size: (batch_size, num_slots, slot_len)
                                              it's a batch of sets of slot vectors
                 slot_vectors2 (torch.FloatTensor) --  a batch of outputs from the slot encoder 1 time step later
                                              size: (batch_size, num_slots, slot_len)
                                              it's a batch of sets of slot vectors
+                negatives (tuple) -- sampled negatives from sample_negatives (None means use the whole batch)
                           """
 
         batch_size, num_slots, slot_len = slot_vectors1.shape
@@ -98,8 +150,25 @@ class SlotSTDIMModel(nn.Module):
         #        for each example (set of 8 slots), for each slot, dot product with every other slot at next time step
 
 
-        slot_vectors1 = self.project_slot_len_slot_len(slot_vectors1) # (batch_size, num_slots, slot_len)
         slot_vectors1 = slot_vectors1.transpose(1, 0) # (num_slots, batch_size, slot_len)
+
+        if negatives is not None:
+            # sampled softmax: only score each slot vector against its positive (column 0) and the K sampled negatives
+            logits = sampled_logits(slot_vectors1, slot_vectors2.transpose(1, 0), negatives) # (num_slots, batch_size, 1 + K)
+            if self.negative_queue is not None:
+                logits = torch.cat([logits, self.negative_queue.extra_logits(slot_vectors1)], dim=-1)
+            loss, acc = sampled_info_nce(logits)
+            if self.args.symmetric_loss:
+                # no transpose to reuse here, so score the t+1 anchors against the sampled t candidates
+                reverse_loss, _ = sampled_info_nce(sampled_logits(slot_vectors2.transpose(1, 0), slot_vectors1,
+                                                                  negatives))
+                loss = (loss + reverse_loss) / 2
+            return loss, 100 * acc
+
+        # when training data parallel, the slot vectors at t+1 of every process are the candidates, and our
+        # positives start at offset in them
+        local_slot_vectors2 = slot_vectors2.transpose(1, 0) # (num_slots, batch_size, slot_len)
+        slot_vectors2, offset = gather_batch(slot_vectors2, dim=0)
         slot_vectors2 = slot_vectors2.permute(1, 2, 0) # (num_slots, slot_len, batch_size) preps for batched mat mul
 
 
@@ -112,6 +181,21 @@ class SlotSTDIMModel(nn.Module):
         #               logit = torch.dot(slot_vectors1[slot_index, batch1_index, :], slot_vectors2[slot_index, :, batch2_index])
         #               logits[slot_index, batch1_index, batch2_index] = logit
         logits = torch.matmul(slot_vectors1, slot_vectors2) # (num_slots, batch_size, batch_size)
+        # the t+1 -> t direction comes for free: row j of the transpose scores slot_vectors2[j] against every
+        # slot vector at t (taken before the queue columns are appended, those only hold t+1 negatives)
+        reverse_logits = None
+        if self.args.symmetric_loss and not is_distributed():
+            reverse_logits = logits.transpose(1, 2)
+        elif self.args.symmetric_loss:
+            # with a gathered batch the transpose has the wrong rows: score our t+1 slot vectors against the
+            # gathered t ones instead
+            all_slot_vectors1, _ = gather_batch(slot_vectors1, dim=1)
+            reverse_logits = torch.matmul(local_slot_vectors2, all_slot_vectors1.transpose(1, 2))
+
+        if self.negative_queue is not None:
+            # slot vectors of the same slot from past batches are extra negatives (the positive stays on the diagonal)
+            extra_logits = self.negative_queue.extra_logits(slot_vectors1) # (num_slots, batch_size, queue_len)
+            logits = torch.cat([logits, extra_logits], dim=-1)
 
         # logits represents num_slot sets of batch_size different batch_size-way classification problems
         # which is represented by num_slot different batch_size x batch_size matrices
@@ -119,26 +203,26 @@ class SlotSTDIMModel(nn.Module):
         # aka the the correct logit in the ith row is the ith element, so we represent that
         # with a target variable that is a set of num_slot vectors each of value torch.arange(batch_size)
         # [0, 1, 2, ... nbatch_size-1], which represents which element in each row of the matrix is the correct answer
-        target = torch.stack([torch.arange(batch_size) for i in range(num_slots)]).to(self.device)
+        target = offset_target(diagonal_target(batch_size, num_slots, self.device), offset)
 
         # flatten logits to be a large set of size batch_size logits
         # aka we now have batch_size * num_slots different batch_size-way classification problems
         inp = logits.reshape(batch_size * num_slots, -1)
-        # do the same for the target now for each of the batch_size*num_slots different batch_size-way classification problems
-        # we have an int label
-        target = target.reshape(batch_size*num_slots,)
+        # (the target is already flat: one int label for each of the batch_size*num_slots different
+        # batch_size-way classification problems)
 
 
-        loss = nn.CrossEntropyLoss()(inp, target)
+        loss = nn.CrossEntropyLoss()(inp.float(), target)
+        if reverse_logits is not None:
+            reverse_inp = reverse_logits.reshape(batch_size * num_slots, -1)
+            loss = (loss + nn.CrossEntropyLoss()(reverse_inp.float(), target)) / 2
 
-        guesses = torch.argmax(inp.detach(), dim=1)
-        is_correct = torch.eq(guesses, target)
-        acc = 100 * torch.mean(is_correct.to(torch.float)).item()
+        acc = 100 * contrastive_accuracy(inp, target)
 
         return loss, acc
 
 
-    def calc_slot_global_to_local_loss(self, slot_vectors, slot_maps):
+    def calc_slot_global_to_local_loss(self, slot_vectors, slot_maps, negatives=None):
         """ Compute slot-based global to local loss.
 
         Arguments:
@@ -147,9 +231,12 @@ class SlotSTDIMModel(nn.Module):
                                              it's a batch of sets of slot vectors
 
         slot_maps (torch.FloatTensor) -- a batch of intermediate layer feature maps from the encoder
-                                        (segregated into num_slots groups of num_feat_maps_per_slot)
-                                        size: (batch_size, num_slots, num_feat_maps_per_slot,
-                                               height_feat_map, width_feat_map)
+                                        (segregated into num_slots groups of num_feat_maps_per_slot),
+                                        laid out slot major (see calc_shared_inputs) because
+                                        logically the outermost loop is over slots and the next one is over the
+                                        spatial dims of the feature maps, with the depth innermost for projection
+                                        size: (num_slots, height_feat_map, width_feat_map, batch_size,
+                                               num_feat_maps_per_slot)
 
         Returns:
                 loss (torch.float): the loss
@@ -157,22 +244,29 @@ class SlotSTDIMModel(nn.Module):
         """
         # N = batch_size
         N, num_slots, slot_len = slot_vectors.shape
-        N, num_slots, num_feat_maps_per_slot, h, w = slot_maps.shape  # h,w are height and width of each feature map
+        num_slots, h, w, N, num_feat_maps_per_slot = slot_maps.shape  # h,w are height and width of each feature map
 
         # permute tensor to make num_slots b/c logically the outermost loop is over slots
         slot_vectors = slot_vectors.transpose(1, 0)  # (num_slots, N, slot_len)
-        slot_maps = slot_maps.transpose(1, 0)  # (num_slots, N, num_feat_maps_per_slot, h, w)
-
-        # permute slot_map tensor to be num_slots,h,w,N,num_feat_maps_per_slot because
-        # the next outermost loop is spatial dims of feature maps
-        # also we want num_feat_maps_per_slot dimension to be outermost dimension for projection
-        slot_maps = slot_maps.permute(0, 3, 4, 1, 2)  # (num_slots, h, w, N, num_feat_maps_per_slot)
 
         # projects the depth at each spatial dimension of the slot_maps to be the same length as a global slot vector
         slot_maps = self.project_to_slot_len(slot_maps)  # (num_slots, h, w, N, slot_len)
 
+        if negatives is not None:
+            # sampled softmax: (num_slots, h, w, N, 1 + K) logits instead of (num_slots, h, w, N, N)
+            loss, acc = sampled_info_nce(sampled_logits(slot_maps, slot_vectors[:, None, None], negatives))
+            return loss, 100 * acc
+
+        if self.args.loss_chunk_size > 0:
+            # same loss, but the (num_slots, h, w, N, N) scores are only ever built chunk_size rows at a time
+            loss, acc = blocked_info_nce(slot_maps, slot_vectors[:, None, None], self.args.loss_chunk_size)
+            return loss, 100 * acc
+
         ## Prep for the big matrix multiplication
 
+        # the slot vectors of every process when training data parallel (offset: where ours start)
+        slot_vectors, offset = gather_batch(slot_vectors, dim=1)
+
         # insert dummy dimensions at dimensions 1 and 2 so we can broadcast the height and width from the slot_maps
         slot_vectors = slot_vectors.unsqueeze(1).unsqueeze(2)  # (num_slots, 1, 1, N, slot_len)
 
@@ -204,7 +298,7 @@ class SlotSTDIMModel(nn.Module):
 
         # the scores tensor represents unnormalized logtits of num_slots * h * w * N  N-way classification problems
         # so we can actually just flatten this tensor to be (num_slots * h * w * N, N)
-        inp = scores.reshape(-1, N)
+        inp = scores.reshape(-1, scores.shape[-1])
 
         # we can also look at "scores" as num_slots * h * w NxN score matrices
         # the diagonals of each of these little score matrices represent the dot product of a
@@ -219,69 +313,73 @@ class SlotSTDIMModel(nn.Module):
         # the the correct class to classification problem number 0 is 0, to problem number 1 answer is 1,
         # problem number N-1 is N-1
         # so the overall target is just torch.range(N) repeated num_slots * h * w times
-        target = torch.arange(N).repeat(num_slots * h * w).to(self.device)
+        target = offset_target(diagonal_target(N, num_slots * h * w, self.device), offset)
 
         # the loss
-        loss = nn.CrossEntropyLoss()(inp, target)
+        loss = nn.CrossEntropyLoss()(inp.float(), target)
 
         # guesses
         # to compute contrastive accuracy, we can just get the argmax of each score and compare that with the target
-        guesses = torch.argmax(inp.detach(), dim=1)
-        is_correct = torch.eq(guesses, target)
-        acc = 100 * torch.mean(is_correct.to(torch.float)).item()
+        acc = 100 * contrastive_accuracy(inp, target)
 
         return loss, acc
 
-    def calc_slot_local_to_local_loss(self, slot_maps1, slot_maps2):
+    def calc_slot_local_to_local_loss(self, slot_maps1, slot_maps2, negatives=None):
         """
 
         computes slot-based local to local loss
         Arguments:
             slot_maps1 (torch.FloatTensor) -- a batch of intermediate layer feature maps from the encoder
-                                             (segregated into num_slots groups of num_feat_maps_per_slot)
-                                              size: (batch_size, num_slots, num_feat_maps_per_slot,
-                                                    height_feat_map, width_feat_map)
+                                             (segregated into num_slots groups of num_feat_maps_per_slot),
+                                             already passed through project_local_len_to_local_len
+                                              size: (batch_size, height_feat_map, width_feat_map,
+                                                     num_slots, num_feat_maps_per_slot)
 
            slot_maps2 (torch.FloatTensor) -- a batch of intermediate layer feature maps from the encoder
-                                             (segregated into num_slots groups of num_feat_maps_per_slot)
-                                              size: (batch_size, num_slots, num_feat_maps_per_slot,
-                                                    height_feat_map, width_feat_map)
+                                             (segregated into num_slots groups of num_feat_maps_per_slot),
+                                             laid out slot major (see calc_shared_inputs)
+                                              size: (num_slots, height_feat_map, width_feat_map,
+                                                     batch_size, num_feat_maps_per_slot)
 
         Returns:
                 loss (Torch.float): the loss
                 acc (Torch.float): the contrastive accuracy
         """
-        N, num_slots, num_feat_maps_per_slot, h, w = slot_maps1.shape
+        num_slots, h, w, N, num_feat_maps_per_slot = slot_maps2.shape
+
+        # permute slot_map tensor to be num_slots,h,w,N,num_feat_maps_per_slot because
+        # the outermost loop is over slots and the next outermost loop is spatial dims of feature maps
+        slot_maps1 = slot_maps1.permute(3, 1, 2, 0, 4)  # (num_slots, h, w, N, num_feat_maps_per_slot)
         assert slot_maps1.shape == slot_maps2.shape
 
-        slot_maps1 = slot_maps1.transpose(1, 0)  # (num_slots, N, num_feat_maps_per_slot, h, w)
-        slot_maps2 = slot_maps2.transpose(1, 0)  # (num_slots, N, num_feat_maps_per_slot, h, w)
+        if negatives is not None:
+            # sampled softmax: (num_slots, h, w, N, 1 + K) logits instead of (num_slots, h, w, N, N)
+            loss, acc = sampled_info_nce(sampled_logits(slot_maps1, slot_maps2, negatives))
+            return loss, 100 * acc
 
-        # permute slot_map tensor to be num_slots,h,w,N,num_feat_maps_per_slot because
-        # the next outermost loop is spatial dims of feature maps
-        # also we want num_feat_maps_per_slot dimension to be outermost dimension for projection
-        slot_maps1 = slot_maps1.permute(0, 3, 4, 1, 2)  # (num_slots, h, w, N, num_feat_maps_per_slot)
-        slot_maps2 = slot_maps2.permute(0, 3, 4, 1, 2)  # (num_slots, h, w, N, num_feat_maps_per_slot)
+        if self.args.loss_chunk_size > 0:
+            # same loss, but the (num_slots, h, w, N, N) scores are only ever built chunk_size rows at a time
+            loss, acc = blocked_info_nce(slot_maps1, slot_maps2, self.args.loss_chunk_size)
+            return loss, 100 * acc
 
-        slot_maps1 = self.project_local_len_to_local_len(slot_maps1)  # (num_slots, h, w, N, num_feat_maps_per_slot)
+        # the slot maps of every process when training data parallel (offset: where ours start)
+        slot_maps2, offset = gather_batch(slot_maps2, dim=3)
 
         # prep for matmul
         slot_maps2 = slot_maps2.transpose(3, 4)  # (num_slots, h, w,  num_feat_maps_per_slot, N)
 
         scores = torch.matmul(slot_maps1, slot_maps2)  # (num_slots, h, w, N, N)
 
-        inp = scores.reshape(-1, N)
+        inp = scores.reshape(-1, scores.shape[-1])
 
-        target = torch.arange(N).repeat(num_slots * h * w).to(self.device)
+        target = offset_target(diagonal_target(N, num_slots * h * w, self.device), offset)
 
         # the loss
-        loss = nn.CrossEntropyLoss()(inp, target)
+        loss = nn.CrossEntropyLoss()(inp.float(), target)
 
         # guesses
         # to compute contrastive accuracy, we can just get the argmax of each score and compare that with the target
-        guesses = torch.argmax(inp.detach(), dim=1)
-        is_correct = torch.eq(guesses, target)
-        acc = 100 * torch.mean(is_correct.to(torch.float)).item()
+        acc = 100 * contrastive_accuracy(inp, target)
 
         return loss, acc
 
@@ -291,7 +389,8 @@ class SlotSTDIMModel(nn.Module):
                           same slot of different slots
 
             Arguments:
-                slot_vectors1 (torch.FloatTensor) --  a batch of outputs from the slot encoder
+                slot_vectors1 (torch.FloatTensor) --  a batch of outputs from the slot encoder,
+                                             already passed through project_slot_len_slot_len
                                              size: (batch_size, num_slots, slot_len)
                                              it's a batch of sets of slot vectors
                 slot_vectors2 (torch.FloatTensor) --  a batch of outputs from the slot encoder 1 time step later
@@ -305,7 +404,6 @@ class SlotSTDIMModel(nn.Module):
         #        for each example (set of 8 slots), for each slot, dot product with every other slot at next time step
 
 
-        slot_vectors1 = self.project_slot_len_slot_len(slot_vectors1) # (batch_size, num_slots, slot_len)
         slot_vectors2 = slots_vectors2.transpose(2, 1) # (batch_size, slot_len, num_slots) preps for batched mat mul
 
 
@@ -325,21 +423,18 @@ class SlotSTDIMModel(nn.Module):
         # aka the the correct logit in the ith row is the ith element, so we represent that
         # with a target variable that is a set of batch_size vectors each of value torch.arange(num_slots)
         # [0, 1, 2, ... num_slots-1], which represents which element in each row of the matrix is the correct answer
-        target = torch.stack([torch.arange(num_slots) for i in range(batch_size)]).to(self.device)
+        target = diagonal_target(num_slots, batch_size, self.device)
 
         # flatten logits to be a large set of size num_slot logits
         # aka we now have batch_size * num_slots different num_slot-way classification problems
         inp = logits.reshape(batch_size * num_slots, -1)
-        # do the same for the target now for each of the batch_size*num_slots different num_slot-way classification problems
-        # we have an int label
-        target = target.reshape(batch_size*num_slots,)
+        # (the target is already flat: one int label for each of the batch_size*num_slots different
+        # num_slot-way classification problems)
 
 
-        loss = nn.CrossEntropyLoss()(inp, target)
+        loss = nn.CrossEntropyLoss()(inp.float(), target)
 
-        guesses = torch.argmax(inp.detach(), dim=1)
-        is_correct = torch.eq(guesses, target)
-        acc = 100 * torch.mean(is_correct.to(torch.float)).item()
+        acc = 100 * contrastive_accuracy(inp, target)
 
         return loss, acc
 
@@ -348,9 +443,10 @@ class SlotSTDIMModel(nn.Module):
         """computes slot-based slot diversity local to local loss
                 Arguments:
                     slot_maps1 (torch.FloatTensor) -- a batch of intermediate layer feature maps from the encoder
-                                                     (segregated into num_slots groups of num_feat_maps_per_slot)
-                                                      size: (batch_size, num_slots, num_feat_maps_per_slot,
-                                                            height_feat_map, width_feat_map)
+                                                     (segregated into num_slots groups of num_feat_maps_per_slot),
+                                                     already passed through project_local_len_to_local_len
+                                                      size: (batch_size, height_feat_map, width_feat_map,
+                                                             num_slots, num_feat_maps_per_slot)
 
                    slot_maps2 (torch.FloatTensor) -- a batch of intermediate layer feature maps from the encoder
                                                      (segregated into num_slots groups of num_feat_maps_per_slot)
@@ -374,14 +470,9 @@ class SlotSTDIMModel(nn.Module):
                                       scores[batch_index, i, j, slot1_index, slot2_index] = score
 
                 """
-        N, num_slots, num_feat_maps_per_slot, h, w = slot_maps1.shape
-        assert slot_maps1.shape == slot_maps2.shape
-
-        slot_maps1 = slot_maps1.permute(0, 3, 4, 1, 2) # (N, h, w, num_slots, num_feat_maps_per_slot)
-        slot_maps2 = slot_maps2.permute(0, 3, 4, 2, 1)# (N, h, w, num_slots, num_feat_maps_per_slot)
+        N, num_slots, num_feat_maps_per_slot, h, w = slot_maps2.shape
 
-        slot_maps1 = self.project_local_len_to_local_len(slot_maps1) # shape remains (N, h, w, num_slots,
-                                                                                    # num_feat_maps_per_slot)
+        slot_maps2 = slot_maps2.permute(0, 3, 4, 2, 1)# (N, h, w, num_feat_maps_per_slot, num_slots)
 
         # for every example in batch, for every spatial location, for every set of slotmaps in slot_maps1
         # dot product with every other
@@ -393,14 +484,12 @@ class SlotSTDIMModel(nn.Module):
 
         # ground truth is the index diagonal of all the N * h * w little (num_slot,num_slot) matrices
         # aka torch.arange(num_slots) repeated N * h * w * num_slots times
-        target = torch.arange(num_slots).repeat(N * h * w).to(self.device)
+        target = diagonal_target(num_slots, N * h * w, self.device)
 
 
-        loss = nn.CrossEntropyLoss()(inp, target)
+        loss = nn.CrossEntropyLoss()(inp.float(), target)
 
-        guesses = torch.argmax(inp.detach(), dim=1)
-        is_correct = torch.eq(guesses, target)
-        acc = 100 * torch.mean(is_correct.to(torch.float)).item()
+        acc = 100 * contrastive_accuracy(inp, target)
 
         return loss, acc
 
@@ -7,10 +7,13 @@ from src.utils import calculate_accuracy, calculate_multiple_accuracies, \
 
 class SupervisedModel(nn.Module):
     """Trains slot based encoder in a fully supervised way
-       Assigning one state variable to each slot and training in a simultaneous multi-task way"""
-    def __init__(self, encoder, args, label_keys, wandb=None):
+       Assigning one state variable to each slot and training in a simultaneous multi-task way
+
+       with args.sparse_head, only the (slot, state variable) pairs in pred_mask are computed, see sparse_preds"""
+    def __init__(self, encoder, args, label_keys, logger=None):
         super().__init__()
-        self.wandb = wandb
+        self.sparse_head = getattr(args, "sparse_head", False)
+        self.logger = logger
         self.encoder = encoder
         self.label_keys = label_keys
         self.loc_keys = [k for k in label_keys if k in all_localization_keys]
@@ -29,6 +32,13 @@ class SupervisedModel(nn.Module):
         self.pred_mask = self.get_pred_mask()
         self.label_mask = self.get_label_mask()
 
+        # static index versions of the masks (same row-major order as boolean mask indexing), so neither head
+        # nor labels need dynamic-shape boolean indexing; not persistent so state dicts are unchanged
+        pred_slot_inds, pred_var_inds = self.pred_mask.nonzero(as_tuple=True)
+        self.register_buffer("pred_slot_inds", pred_slot_inds, persistent=False)
+        self.register_buffer("pred_var_inds", pred_var_inds, persistent=False)
+        self.register_buffer("label_inds", self.label_mask.nonzero(as_tuple=True)[0], persistent=False)
+
 
     def get_pred_mask(self):
         """Make mask to mask out which predictions from each slot to use"""
@@ -50,9 +60,22 @@ class SupervisedModel(nn.Module):
         label_mask = torch.tensor([1 if k in self.loc_keys else 0 for k in self.label_keys])
         return label_mask.bool()
 
+    def sparse_preds(self, slots):
+        """same predictions as probe(slots)[:, pred_mask], computing only the pairs in the mask
+
+        the probe's weight rows (and biases) of each pair's state variable are gathered once and dotted with
+        the pair's slot in one batched einsum; gradients flow back into the same probe parameters
+        """
+        weight = self.probe.weight.index_select(0, self.pred_var_inds)  # (num_pairs, slot_len)
+        bias = self.probe.bias.index_select(0, self.pred_var_inds)  # (num_pairs,)
+        pair_slots = slots.index_select(1, self.pred_slot_inds)  # (batch_size, num_pairs, slot_len)
+        return torch.einsum("bpl,pl->bp", pair_slots, weight) + bias
+
     def forward(self, x):
         x = x / 255.
         slots = self.encoder(x)
+        if self.sparse_head:
+            return self.sparse_preds(slots)
         # apply every regressor/classifier to every slot (later we will index out one unique state variable prediction per slot)
         preds = self.probe(slots)
 
@@ -62,22 +85,26 @@ class SupervisedModel(nn.Module):
         return preds
 
     def calc_loss(self, x, y):
-        y = y[:, self.label_mask].float()
+        if self.sparse_head:
+            y = y.index_select(1, self.label_inds).float()
+        else:
+            y = y[:, self.label_mask].float()
         preds = self.forward(x)
-        losses = self.loss_fn(preds, y)
+        losses = self.loss_fn(preds.float(), y)
 
         mode = "tr" if self.training else "val"
-        # for logging purposes capture loss per state variable
-        sv_losses = losses.mean(axis=0).detach().cpu().numpy()
+        # for logging purposes capture loss per state variable (kept on the device, the logger syncs them
+        # every log interval)
+        sv_losses = losses.mean(axis=0).detach()
 
         #sv_accs = calculate_multiple_accuracies(preds.detach().cpu().numpy().argmax(axis=1), y.detach().cpu().numpy())
 
         loss_keys = [k + "_" + mode + "_loss" for k in self.loc_keys]
         # acc_keys = [k + "_" + mode + "_acc" for k in self.label_keys]
         # avg_acc = np.mean(sv_accs)
-        self.wandb.log(dict(zip(loss_keys, sv_losses)))
-        # self.wandb.log(dict(zip(acc_keys, sv_accs)))
-        # self.wandb.log({mode + "_acc": avg_acc})
+        self.logger.log(dict(zip(loss_keys, sv_losses)))
+        # self.logger.log(dict(zip(acc_keys, sv_accs)))
+        # self.logger.log({mode + "_acc": avg_acc})
 
         #main loss is mean over batch and every state variable
         loss = losses.mean()
@@ -1,14 +1,17 @@
 import torch.nn as nn
 import torch
-from src.utils import calculate_accuracy
+from src.running_metrics import diagonal_target, contrastive_accuracy
+from src.encoders import encode_pair
+from src.contrastive import blocked_info_nce
+from src.distributed import gather_batch, offset_target
 
 class STDIMModel(nn.Module):
-    def __init__(self, encoder, args, global_vector_len, device=torch.device('cpu'), wandb=None):
+    def __init__(self, encoder, args, global_vector_len, device=torch.device('cpu'), logger=None):
         super().__init__()
         self.encoder = encoder
         self.fmap_encoder = encoder.get_f5
         self.global_vector_len = global_vector_len
-        self.wandb = wandb
+        self.logger = logger
         self.args = args
 
         self.score_fxn1 = nn.Linear(self.global_vector_len, self.encoder.local_vector_len) # x1 = global, x2=patch, n_channels = 32
@@ -19,15 +22,18 @@ class STDIMModel(nn.Module):
         N, sy, sx, d = local_tp1.shape
         # Loss 1: Global at time t, f5 patches at time t+1
         glob_score = self.score_fxn1(global_t)
+        # the global vectors of every process when training data parallel (offset: where ours start)
+        glob_score, offset = gather_batch(glob_score, dim=0)
+        num_keys = glob_score.shape[0]
         local_flattened = local_tp1.reshape(-1, d)
         # [N*sy*sx, d] @  [d, N] = [N*sy*sx, N ] -> dot product of every global vector in batch with local voxel at all spatial locations for all examples in the batch
         # then reshape to sy*sx, N, N then to sy*sx*N, N
-        logits1 = torch.matmul(local_flattened, glob_score.t()).reshape(N, sy * sx, -1).transpose(1, 0).reshape(-1, N)
+        logits1 = torch.matmul(local_flattened, glob_score.t()).reshape(N, sy * sx, -1).transpose(1, 0).reshape(-1, num_keys)
         # we now have sy*sx N x N matrices where the diagonals correspond to dot product between pairs consecutive in time at the same bagtch index
         # aka the correct answer. So the correct logit index is the diagonal sx*sy times
-        target1 = torch.arange(N).repeat(sx * sy).to(self.device)
-        loss1 = nn.CrossEntropyLoss()(logits1, target1)
-        acc1 = calculate_accuracy(logits1.detach().cpu().numpy(), target1.detach().cpu().numpy())
+        target1 = offset_target(diagonal_target(N, sx * sy, self.device), offset)
+        loss1 = nn.CrossEntropyLoss()(logits1.float(), target1)
+        acc1 = contrastive_accuracy(logits1, target1)
         return loss1, acc1
 
 
@@ -37,17 +43,30 @@ class STDIMModel(nn.Module):
         local_t_score = self.score_fxn2(local_t.reshape(-1, d))
         transformed_local_t = local_t_score.reshape(N, sy*sx,d).transpose(0,1)
         local_tp1 = local_tp1.reshape(N, sy * sx, d).transpose(0, 1)
-        logits2 = torch.matmul(transformed_local_t, local_tp1.transpose(1, 2)).reshape(-1, N)
-        target2 = torch.arange(N).repeat(sx * sy).to(self.device)
-        loss2 = nn.CrossEntropyLoss()(logits2, target2)
-        acc2 = calculate_accuracy(logits2.detach().cpu().numpy(), target2.detach().cpu().numpy())
+        if self.args.loss_chunk_size > 0:
+            # same loss without materializing the (sy*sx, N, N) scores
+            return blocked_info_nce(transformed_local_t, local_tp1, self.args.loss_chunk_size)
+        local_tp1, offset = gather_batch(local_tp1, dim=1)
+        logits2 = torch.matmul(transformed_local_t, local_tp1.transpose(1, 2)).reshape(-1, local_tp1.shape[1])
+        target2 = offset_target(diagonal_target(N, sx * sy, self.device), offset)
+        loss2 = nn.CrossEntropyLoss()(logits2.float(), target2)
+        acc2 = contrastive_accuracy(logits2, target2)
         return loss2, acc2
 
     def calc_loss(self, xt, a, xtp1):
-        f_t = self.encoder(xt)
-        f_tp1 = self.encoder(xtp1)
-        fmap_t = self.fmap_encoder(xt).permute(0, 2, 3, 1)
-        fmap_tp1 = self.fmap_encoder(xtp1).permute(0, 2, 3, 1)
+        if self.args.concat_forward:
+            # one trunk pass over the 2N batch (the unused t+1 global vector is cheap next to the trunk)
+            out_t, out_tp1 = encode_pair(self.encoder, xt, xtp1,
+                                         fn=self.encoder.get_intermediates,
+                                         concat=True)
+            f5_tp1 = out_tp1["f5"]
+        else:
+            # the global vector at t+1 is never used, so only run the trunk up to f5 for xtp1
+            out_t = self.encoder.get_intermediates(xt)
+            f5_tp1 = self.fmap_encoder(xtp1)
+        f_t = out_t["global_vec"]
+        fmap_t = out_t["f5"].permute(0, 2, 3, 1)
+        fmap_tp1 = f5_tp1.permute(0, 2, 3, 1)
 
 
         loss1, acc1 = self.calc_global_to_local(f_t, fmap_tp1)
@@ -61,9 +80,9 @@ class STDIMModel(nn.Module):
 
     def log(self, name, scalar):
         if self.training:
-            self.wandb.log({"tr_"+ name: scalar})
+            self.logger.log({"tr_"+ name: scalar})
         else:
-            self.wandb.log({"val_"+ name: scalar})
+            self.logger.log({"val_"+ name: scalar})
 
 
 
@@ -0,0 +1,86 @@
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def to_cpu(state):
+    """copy of a (nested dict / list of) state with every tensor copied to host memory"""
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def get_rng_state():
+    state = dict(torch=torch.get_rng_state(), numpy=np.random.get_state(), python=random.getstate())
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class AsyncCheckpointer(object):
+    """Writes training checkpoints from a background thread
+
+    save(state) only copies the state to host memory (so training can go on updating the live tensors) and
+    hands it to the writer thread, which torch.saves it to <path>.tmp and then os.replaces it over path. The
+    rename is atomic, so path always holds the last complete checkpoint, even if the job is preempted in the
+    middle of a write. If the writer is still busy with an older checkpoint when a new one is queued, save()
+    waits for it. If a write fails, the error is raised by the next save() or by close().
+
+    Args:
+        path (str): where the checkpoint lives
+    """
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing the checkpoint to %s failed" % self.path) from error
+
+    def save(self, state):
+        self._raise_error()
+        self.queue.put(to_cpu(state))
+
+    def _write_loop(self):
+        while True:
+            state = self.queue.get()
+            if state is None:
+                break
+            # keep draining the queue after a failure, so save() never blocks on a dead writer
+            try:
+                self._write(state)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, state):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        """waits until every queued checkpoint is on disk (or raises the error of a failed write)"""
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
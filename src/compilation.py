@@ -0,0 +1,87 @@
+import copy
+import warnings
+import torch
+import torch.nn as nn
+
+
+def to_channels_last(tensor):
+    """NHWC layout for 4d tensors (frames, conv weights), everything else is returned as is"""
+    return tensor.contiguous(memory_format=torch.channels_last) if tensor.dim() == 4 else tensor
+
+
+def compile_model(model, mode="none"):
+    """compiles the encoder and the loss of a training model in place
+
+    Arguments:
+        model (nn.Module) -- a model with an encoder and a calc_loss method (e.g. SlotSTDIMModel)
+        mode (str) -- "none": eager
+                      "compile": torch.compile the whole calc_loss (encoder forward + losses), so inductor
+                                 fuses each conv with its ReLU and the reshapes/elementwise ops of the losses
+                      "script": TorchScript the encoder's conv stacks (what "compile" falls back to on torch
+                                versions without torch.compile)
+
+    Returns:
+        the mode actually used
+
+    Conv weights are also moved to channels_last, which is what the fused conv kernels want
+    (feed the frames through to_channels_last too).
+    """
+    if mode == "none":
+        return mode
+    model.to(memory_format=torch.channels_last)
+    if mode == "compile" and not hasattr(torch, "compile"):
+        warnings.warn("torch.compile is not available in torch %s, falling back to TorchScript" % torch.__version__)
+        mode = "script"
+
+    if mode == "compile":
+        # the negative queue bookkeeping (python int pointers) and the logging are host-side side effects that
+        # would only cause graph breaks and recompiles, so they stay eager
+        negative_queue = getattr(model, "negative_queue", None)
+        if negative_queue is not None:
+            negative_queue.update = torch._dynamo.disable(negative_queue.update)
+        logger = getattr(model, "logger", None)
+        if logger is not None:
+            logger.log = torch._dynamo.disable(logger.log)
+        model.calc_loss = torch.compile(model.calc_loss)
+    elif mode == "script":
+        script_encoder(model.encoder)
+    else:
+        assert False, "I don't recognize the compile mode: {}!".format(mode)
+    return mode
+
+
+def script_encoder(encoder):
+    """TorchScripts the nn.Sequential segments an ST-DIM style encoder runs (see STDIMEncoder.segment)
+
+    the encoder keeps its eager layers, which the forward passes still index from python, and runs the
+    scripted segments instead. Those share their parameters with the eager layers and aren't registered as
+    submodules, so optimizers, checkpointing and encoder.pt are unaffected.
+    """
+    for name in encoder.segment_names():
+        encoder.scripted_segments[name] = torch.jit.script(encoder.segment(name))
+    return encoder
+
+
+def export_scripted_encoder(encoder, sample_frame, path, state_dict=None):
+    """saves a frozen TorchScript version of encoder's forward that can be loaded with torch.jit.load alone
+    (with the weights of state_dict if given, e.g. the best encoder.pt of a run, else encoder's own)
+
+    The ST-DIM encoders' python-level reshapes and checkpointing switches aren't scriptable, so we fall back
+    to tracing the eval-mode forward pass. Freezing inlines the weights, and optimize_for_inference folds
+    batch norms into convs and fuses each conv with its ReLU.
+    """
+    # the copy runs the eager segments, the scripted ones can't be deepcopied
+    scripted_segments = getattr(encoder, "scripted_segments", None)
+    memo = {} if scripted_segments is None else {id(scripted_segments): {}}
+    encoder = copy.deepcopy(encoder, memo).eval()
+    if state_dict is not None:
+        encoder.load_state_dict(state_dict)
+    sample_frame = sample_frame.float().to(next(encoder.parameters()).device)
+    with torch.no_grad():
+        try:
+            scripted = torch.jit.script(encoder)
+        except Exception:
+            scripted = torch.jit.trace(encoder, sample_frame, check_trace=False)
+        scripted = torch.jit.optimize_for_inference(torch.jit.freeze(scripted))
+    torch.jit.save(scripted, path)
+    return scripted
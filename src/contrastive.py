@@ -0,0 +1,192 @@
+import copy
+import torch
+import torch.nn as nn
+from src.running_metrics import zero_target, contrastive_accuracy
+
+
+class _BlockedInfoNCE(torch.autograd.Function):
+    """InfoNCE over stacked N x N score matrices without ever materializing them
+
+    queries: (..., N, d), keys: (..., N, d) (keys may broadcast over the leading dims of queries)
+    scores[..., i, j] = queries[..., i, :] . keys[..., j, :] and the positive for row i is column i.
+
+    The forward pass computes the logsumexp of each row of scores chunk_size rows at a time and only keeps
+    the (..., N) logsumexps. The backward pass recomputes each chunk of scores and turns it into the softmax
+    gradient on the fly, so peak memory is O(chunk_size * N) per score matrix instead of O(N^2).
+    """
+    @staticmethod
+    def forward(ctx, queries, keys, chunk_size):
+        N = queries.shape[-2]
+        keys_t = keys.transpose(-1, -2)
+        lse = torch.empty(queries.shape[:-1], dtype=torch.float32, device=queries.device)
+        num_correct = torch.zeros((), dtype=torch.long, device=queries.device)
+        for start in range(0, N, chunk_size):
+            end = min(start + chunk_size, N)
+            scores = torch.matmul(queries[..., start:end, :], keys_t).to(torch.float32)  # (..., c, N)
+            lse[..., start:end] = torch.logsumexp(scores, dim=-1)
+            positives = torch.arange(start, end, device=queries.device)
+            num_correct += torch.eq(scores.argmax(dim=-1), positives).sum()
+
+        pos_scores = (queries * keys).sum(-1).to(torch.float32)  # (..., N)
+        loss = (lse - pos_scores).mean()
+        acc = num_correct.to(torch.float32) / lse.numel()
+
+        ctx.save_for_backward(queries, keys, lse)
+        ctx.chunk_size = chunk_size
+        ctx.mark_non_differentiable(acc)
+        return loss, acc
+
+    @staticmethod
+    def backward(ctx, grad_loss, grad_acc):
+        queries, keys, lse = ctx.saved_tensors
+        N = queries.shape[-2]
+        scale = grad_loss / lse.numel()
+        keys_t = keys.transpose(-1, -2)
+
+        # d loss / d scores = softmax(scores) - onehot(diagonal), scaled by 1 / num_rows
+        grad_queries = torch.empty_like(queries, dtype=torch.float32)
+        grad_keys = torch.zeros_like(keys, dtype=torch.float32)
+        for start in range(0, N, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, N)
+            queries_chunk = queries[..., start:end, :]
+            scores = torch.matmul(queries_chunk, keys_t).to(torch.float32)  # (..., c, N)
+            probs = torch.exp(scores - lse[..., start:end, None]).to(queries.dtype)
+            grad_queries[..., start:end, :] = torch.matmul(probs, keys) - keys[..., start:end, :]
+            grad_keys += torch.matmul(probs.transpose(-1, -2), queries_chunk).to(torch.float32).sum_to_size(keys.shape)
+        grad_keys -= queries.to(torch.float32).sum_to_size(keys.shape)
+
+        return (scale * grad_queries).to(queries.dtype), (scale * grad_keys).to(keys.dtype), None
+
+
+def blocked_info_nce(queries, keys, chunk_size):
+    """Memory-bounded equivalent of
+
+        scores = queries @ keys.transpose(-1, -2)    # (..., N, N)
+        loss = CrossEntropyLoss()(scores.reshape(-1, N), arange(N).repeat(...))
+
+    Arguments:
+        queries (torch.FloatTensor) -- size (..., N, d)
+        keys (torch.FloatTensor) -- size (..., N, d), can broadcast over the leading dims of queries
+        chunk_size (int) -- how many rows of each N x N score matrix to have in memory at once
+
+    Returns:
+        loss (torch.float): the mean cross entropy over all rows
+        acc (torch.float): fraction of rows whose highest score is the positive
+    """
+    keys = keys.to(queries.dtype)
+    return _BlockedInfoNCE.apply(queries, keys, chunk_size)
+
+
+class SlotNegativeQueue(nn.Module):
+    """Momentum encoder + FIFO queue of past slot vectors (one queue per slot index), MoCo style
+
+    The queue holds slot vectors of xtp1 from previous batches, encoded by an exponential moving average of
+    the encoder so they stay consistent as the encoder trains. They are scored as extra negatives in the
+    time-contrastive losses, so the number of negatives is no longer tied to the batch size.
+
+    Args:
+        encoder (nn.Module): the slot encoder, maps frames to (N, num_slots, slot_len)
+        queue_len (int): how many past slot vectors to keep per slot
+        momentum (float): EMA coefficient of the key encoder
+    """
+    def __init__(self, encoder, num_slots, slot_len, queue_len, momentum=0.99):
+        super().__init__()
+        self.queue_len = queue_len
+        self.momentum = momentum
+        self.key_encoder = copy.deepcopy(encoder)
+        for param in self.key_encoder.parameters():
+            param.requires_grad = False
+        self.register_buffer("queue", torch.zeros(num_slots, queue_len, slot_len))
+        # python ints so reading them never syncs with the device (saved via get/set_extra_state)
+        self.ptr = 0
+        self.num_filled = 0
+
+    def get_extra_state(self):
+        return dict(ptr=self.ptr, num_filled=self.num_filled)
+
+    def set_extra_state(self, state):
+        self.ptr, self.num_filled = state["ptr"], state["num_filled"]
+
+    def extra_logits(self, queries):
+        """scores of queries (num_slots, N, slot_len) against the queued slot vectors of the same slot index
+
+        Returns:
+            (num_slots, N, num_filled) logits to concatenate after the in-batch (num_slots, N, N) logits
+        """
+        # a copy, since autograd keeps it for the backward pass and update() overwrites the queue before that
+        negatives = self.queue[:, :self.num_filled].to(queries.dtype, copy=True)
+        return torch.matmul(queries, negatives.transpose(1, 2))
+
+    @torch.no_grad()
+    def update(self, encoder, x):
+        """EMA update of the key encoder, then enqueue its slot vectors for the batch x"""
+        for key_param, param in zip(self.key_encoder.parameters(), encoder.parameters()):
+            key_param.mul_(self.momentum).add_(param.detach(), alpha=1 - self.momentum)
+        for key_buffer, buffer in zip(self.key_encoder.buffers(), encoder.buffers()):
+            key_buffer.copy_(buffer)
+
+        keys = self.key_encoder(x).transpose(0, 1)[:, -self.queue_len:]  # (num_slots, N, slot_len)
+        N = keys.shape[1]
+        idx = torch.arange(self.ptr, self.ptr + N, device=keys.device) % self.queue_len
+        self.queue[:, idx] = keys.to(self.queue.dtype)
+        self.ptr = (self.ptr + N) % self.queue_len
+        self.num_filled = min(self.num_filled + N, self.queue_len)
+
+
+def sample_negatives(N, num_negatives, device, episode_ids=None):
+    """Samples the negatives for a sampled-softmax contrastive loss over a batch of N anchors
+
+    One set of num_negatives distinct batch indices is drawn for the whole step and shared by all anchors
+    (and all slots/spatial locations), so scoring it is one gather plus a batched matmul. For each anchor,
+    candidates that are not valid negatives are masked out: the anchor itself and, with episode_ids, every
+    example from the anchor's own episode.
+
+    The log correction log(num_candidates / num_valid_sampled) is added to the sampled negative logits, so
+    that (num_candidates / num_valid_sampled) * sum(exp(sampled)) is an unbiased estimate of the sum over
+    all candidates and the loss stays consistent with the exact one.
+
+    Returns:
+        idx (torch.LongTensor): (K,) sampled batch indices
+        valid (torch.BoolTensor): (N, K) whether idx[k] is a valid negative for anchor n
+        log_correction (torch.FloatTensor): (N,) per-anchor logit correction
+    """
+    idx = torch.randperm(N, device=device)[:num_negatives]
+    anchors = torch.arange(N, device=device)
+    valid = idx[None, :] != anchors[:, None]
+    if episode_ids is None:
+        num_candidates = torch.full((N,), N - 1, device=device)
+    else:
+        valid = valid & (episode_ids[idx][None, :] != episode_ids[:, None])
+        num_candidates = N - torch.bincount(episode_ids)[episode_ids]
+    num_sampled = valid.sum(1)
+    log_correction = torch.log(num_candidates.clamp(min=1).to(torch.float32)
+                               / num_sampled.clamp(min=1).to(torch.float32))
+    return idx, valid, log_correction
+
+
+def sampled_logits(queries, keys, negatives):
+    """Logits of each anchor against its positive (column 0) and the sampled negatives (columns 1...K)
+
+    Arguments:
+        queries (torch.FloatTensor) -- size (..., N, d)
+        keys (torch.FloatTensor) -- size (..., N, d), can broadcast over the leading dims of queries
+        negatives (tuple) -- output of sample_negatives
+
+    Returns:
+        logits (torch.FloatTensor) -- size (..., N, 1 + K)
+    """
+    idx, valid, log_correction = negatives
+    keys = keys.to(queries.dtype)
+    pos = (queries * keys).sum(-1, keepdim=True)  # (..., N, 1)
+    neg_keys = keys.index_select(-2, idx)  # (..., K, d)
+    neg = torch.matmul(queries, neg_keys.transpose(-1, -2)) + log_correction[:, None].to(queries.dtype)
+    neg = neg.masked_fill(~valid, float("-inf"))
+    return torch.cat([pos, neg], dim=-1)
+
+
+def sampled_info_nce(logits):
+    """cross entropy and accuracy of logits from sampled_logits (positive in column 0)"""
+    inp = logits.reshape(-1, logits.shape[-1])
+    target = zero_target(inp.shape[0], inp.device)
+    loss = nn.CrossEntropyLoss()(inp.float(), target)
+    return loss, contrastive_accuracy(inp, target)
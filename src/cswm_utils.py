@@ -79,13 +79,12 @@ def get_colors(cmap='Set1', num_colors=9):
 
 
 def pairwise_distance_matrix(x, y):
-    num_samples = x.size(0)
-    dim = x.size(1)
+    """Squared L2 distances between the rows of x [N, D] and y [M, D].
 
-    x = x.unsqueeze(1).expand(num_samples, num_samples, dim)
-    y = y.unsqueeze(0).expand(num_samples, num_samples, dim)
-
-    return torch.pow(x - y, 2).sum(2)
+    Uses ||x||^2 + ||y||^2 - 2 x.y, so the only N x M intermediate is one matmul
+    (no [N, M, D] expanded differences)."""
+    dist = x.pow(2).sum(1).unsqueeze(1) + y.pow(2).sum(1).unsqueeze(0) - 2 * torch.matmul(x, y.t())
+    return dist.clamp(min=0)
 
 
 def get_act_fn(act_fn):
@@ -63,11 +63,14 @@ def get_transitions(args, seed=42, keep_as_episodes=True, min_episode_length=8,
 
 
 class EpisodeDataset(torch.utils.data.Dataset):
-    """Create dataset of (o_t, a_t, o_{t+1}) transitions from replay buffer."""
+    """Create dataset of (o_t, a_t, o_{t+1}) transitions from replay buffer.
 
-    def __init__(self, episodes, actions):
+    With return_episode_ids, each item is (o_t, a_t, o_{t+1}, episode index) instead."""
+
+    def __init__(self, episodes, actions, return_episode_ids=False):
         self.episodes = episodes
         self.actions = actions
+        self.return_episode_ids = return_episode_ids
         # Build table for conversion between linear idx -> episode/step idx
         self.idx2episode = []
         step = 0
@@ -91,6 +94,8 @@ class EpisodeDataset(torch.utils.data.Dataset):
         action = self.actions[ep][step]
         next_obs = self.episodes[ep][step + 1] / 255.
 
+        if self.return_episode_ids:
+            return obs, action, next_obs, ep
         return obs, action, next_obs
 
 
@@ -1,4 +1,4 @@
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader, TensorDataset, Sampler
 try:
     import wandb
 except:
@@ -7,7 +7,7 @@ import torch
 from src.data.data_collection import get_transitions, EpisodeDataset
 from src.utils import appendabledict, reformat_label_keys, remove_duplicates, remove_low_entropy_labels
 
-def get_dataloaders(args, keep_as_episodes=True, test_set=False, label_keys=False):
+def get_dataloaders(args, keep_as_episodes=True, test_set=False, label_keys=False, return_episode_ids=False):
     data, actions, labels = get_transitions(args,
                                            max_frames=args.num_frames,
                                            keep_as_episodes=keep_as_episodes)
@@ -19,7 +19,7 @@ def get_dataloaders(args, keep_as_episodes=True, test_set=False, label_keys=Fals
 
     dataloaders = []
     for data, action, label in zip(all_data, all_actions, all_labels):
-        dataloader = create_dataloader(data, action, label, args.batch_size, keep_as_episodes)
+        dataloader = create_dataloader(data, action, label, args.batch_size, keep_as_episodes, return_episode_ids)
         dataloaders.append(dataloader)
 
     if label_keys:
@@ -32,14 +32,61 @@ def get_dataloaders(args, keep_as_episodes=True, test_set=False, label_keys=Fals
     else:
         return dataloaders
 
-def create_dataloader(data, action, label, batch_size, keep_as_episodes=True):
+def create_dataloader(data, action, label, batch_size, keep_as_episodes=True, return_episode_ids=False):
     labels = torch.tensor(list(label.values())).long()
     labels_tensor = labels.transpose(1, 0)
-    dataset = EpisodeDataset(data, action) if keep_as_episodes else TensorDataset(data, labels_tensor)
+    dataset = EpisodeDataset(data, action, return_episode_ids) if keep_as_episodes else TensorDataset(data, labels_tensor)
     dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, drop_last=True)
     return dataloader
 
 
+def rebatch(dataloader, batch_size):
+    """same data as a dataloader from create_dataloader, with a different batch size"""
+    return DataLoader(dataloader.dataset, batch_size=batch_size, shuffle=True, drop_last=True)
+
+
+class ResumableSampler(Sampler):
+    """Shuffles like shuffle=True, but each epoch's order only depends on (seed, epoch), so a resumed run sees
+    exactly the batches it would have seen, and iteration can start part way into an epoch
+
+    With world_size > 1 every process of a data parallel run gets its own 1 / world_size of each epoch's
+    order (like DistributedSampler with drop_last=True).
+
+    Args:
+        num_samples (int): size of the dataset
+        seed (int): base seed of the shuffles
+    """
+    def __init__(self, num_samples, seed=0, rank=0, world_size=1):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """the order of epoch, starting at its start'th sample (of this process's share)"""
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_samples, generator=generator)
+        order = order[:len(self) * self.world_size][self.rank::self.world_size]
+        return iter(order[self.start:].tolist())
+
+    def __len__(self):
+        return self.num_samples // self.world_size
+
+
+def resumable(dataloader, seed, rank=0, world_size=1):
+    """same data as a dataloader from create_dataloader, with a ResumableSampler (call sampler.set_epoch every
+    epoch)"""
+    sampler = ResumableSampler(len(dataloader.dataset), seed, rank, world_size)
+    return DataLoader(dataloader.dataset, batch_size=dataloader.batch_size, sampler=sampler, drop_last=True)
+
+
 def preprocess_data(data, actions, labels, args, keep_as_episodes=True, test_set=False):
     num_datapoints = len(data)
     slices = get_slices(num_datapoints, test_set=test_set)
@@ -0,0 +1,110 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.distributed.nn
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+
+def init_distributed(backend="gloo"):
+    """joins the process group that torchrun describes in the environment (WORLD_SIZE, RANK, MASTER_ADDR, ...), e.g.
+
+        torchrun --nproc_per_node 8 -m scripts.train --no-cuda --method slot-stdim ...
+
+    on the cpu the cores of the node are split evenly between its processes (torchrun would leave each of
+    them a single thread)
+
+    Returns:
+        rank, world_size -- (0, 1) when not launched by torchrun
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 and not dist.is_initialized():
+        dist.init_process_group(backend)
+        if backend == "gloo":
+            local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+            torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+    return get_rank(), get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """only rank 0 logs and saves"""
+    return get_rank() == 0
+
+
+def gather_batch(x, dim=0):
+    """all-gathers x along its batch dimension from every process, so the contrastive losses can use the
+    global batch as negatives
+
+    gradients flow back through the gather: every process receives the sum of the gradients all processes'
+    losses put on its own slice, which (after DDP averages the parameter gradients) is the gradient of the
+    mean loss over processes
+
+    Returns:
+        gathered x (world_size * x.shape[dim] along dim), index of this process's first example in it
+    """
+    if not is_distributed():
+        return x, 0
+    gathered = torch.distributed.nn.functional.all_gather(x.contiguous())
+    return torch.cat(gathered, dim=dim), get_rank() * x.shape[dim]
+
+
+def offset_target(target, offset):
+    """a diagonal_target shifted to where this process's examples sit in a gathered batch"""
+    return target + offset if offset else target
+
+
+def all_reduce_mean(value):
+    """mean of a python number over all processes"""
+    if not is_distributed():
+        return value
+    value = torch.tensor(float(value), dtype=torch.float64)
+    dist.all_reduce(value)
+    return value.item() / get_world_size()
+
+
+class _CalcLoss(nn.Module):
+    """calc_loss as forward, since DistributedDataParallel only hooks into forward"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *batch):
+        return self.model.calc_loss(*batch)
+
+
+class DistributedModel(nn.Module):
+    """DistributedDataParallel training of a model with a calc_loss method
+
+    calc_loss goes through DDP, so parameter gradients are averaged over processes during backward. module is
+    the wrapped model (for saving); encoder is its encoder.
+
+    Unused parameters are expected (e.g. the global head of the slot encoder, or the projections of the
+    losses that are turned off). Buffers are not broadcast from rank 0, since the only ones that change
+    (the negative queue) are per-process state.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.ddp = DistributedDataParallel(_CalcLoss(model), find_unused_parameters=True, broadcast_buffers=False)
+
+    @property
+    def module(self):
+        return self.ddp.module.model
+
+    @property
+    def encoder(self):
+        return self.module.encoder
+
+    def calc_loss(self, *batch):
+        return self.ddp(*batch)
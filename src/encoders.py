@@ -2,6 +2,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import src.cswm_utils as utils
 import numpy as np
 
@@ -14,14 +15,15 @@ class Flatten(nn.Module):
     def __init__(self):
         super().__init__()
     def forward(self, x):
-        return x.view(x.size(0), -1)
+        # reshape, not view: under --compile the conv outputs are channels_last
+        return x.reshape(x.size(0), -1)
 
 
 class SlotFlatten(nn.Module):
     def __init__(self):
         super().__init__()
     def forward(self, x):
-        return x.view(x.size(0), x.size(1), -1)
+        return x.reshape(x.size(0), x.size(1), -1)
 
 
 class ConcatenateSlots(nn.Module):
@@ -33,6 +35,39 @@ class ConcatenateSlots(nn.Module):
         return self.flatten(self.encoder(x))
 
 
+def split_pair(out):
+    """splits an encoder output for a concatenated (xt, xtp1) batch back into its two halves"""
+    if isinstance(out, dict):
+        halves = {k: v.chunk(2) for k, v in out.items()}
+        return {k: v[0] for k, v in halves.items()}, {k: v[1] for k, v in halves.items()}
+    return out.chunk(2)
+
+
+def encode_pair(encoder, xt, xtp1, fn=None, concat=False):
+    """encodes xt and xtp1 either with two calls or with one call on a concatenated 2N batch
+
+    Arguments:
+        encoder (nn.Module) -- the encoder
+        fn (callable) -- what to run on the inputs (e.g. encoder.get_intermediates), defaults to encoder itself
+        concat (bool) -- run a single forward pass over torch.cat([xt, xtp1]) (the ST-DIM encoders have no
+                         batch norm, so this gives the same outputs as two calls)
+
+    Returns:
+        (out_t, out_tp1) -- whatever fn returns (tensor or dict of tensors) for each input
+    """
+    fn = encoder if fn is None else fn
+    if not concat:
+        return fn(xt), fn(xtp1)
+    return split_pair(fn(torch.cat([xt, xtp1])))
+
+
+def conv_output_shape(convs, input_channels, input_size):
+    """(channels, height, width) that convs output for a single (input_channels, *input_size) frame"""
+    with torch.no_grad():
+        out = convs(torch.zeros(1, input_channels, *input_size))
+    return tuple(out.shape[1:])
+
+
 init_ = lambda m: init(m,
        nn.init.orthogonal_,
        lambda x: nn.init.constant_(x, 0),
@@ -40,15 +75,22 @@ init_ = lambda m: init(m,
 
 
 class STDIMEncoder(nn.Module):
-    def __init__(self, input_channels, global_vector_len):
+    """ST-DIM conv encoder
+
+    Args:
+        checkpoint_segments (iterable of str): segments whose activations are recomputed during backward
+                                              instead of stored: "f5" (conv trunk up to f5), "global-head"
+                                              (f5 -> global vector) and, for SlotSTDIMEncoder, "slot-head"
+        input_size (tuple of int): (height, width) of the input frames, every flattened size is inferred
+                                   from it (e.g. 84 x 84 with --downsample or any --screen-size/--crop)
+    """
+    def __init__(self, input_channels, global_vector_len, checkpoint_segments=(), input_size=(210, 160)):
         super().__init__()
         self.global_vector_len = global_vector_len
-        self.final_conv_size = 64 * 9 * 6
-        self.final_conv_shape = (64, 9, 6)
-
+        self.checkpoint_segments = set(checkpoint_segments)
+        self.input_size = tuple(int(size) for size in input_size)
 
-
-        self.layers = nn.Sequential(
+        convs = [
             init_(nn.Conv2d(input_channels, 32, 8, stride=4)), # f1
             nn.ReLU(),
             init_(nn.Conv2d(32, 64, 4, stride=2)), # f3
@@ -57,45 +99,97 @@ class STDIMEncoder(nn.Module):
             nn.ReLU(),
             init_(nn.Conv2d(128, 64, 3, stride=1)), #f7
             nn.ReLU(),
+        ]
+        # (64, 9, 6) for 210 x 160 frames
+        self.final_conv_shape = conv_output_shape(nn.Sequential(*convs), input_channels, self.input_size)
+        self.final_conv_size = int(np.prod(self.final_conv_shape))
+
+        self.layers = nn.Sequential(
+            *convs,
             Flatten(),
             init_(nn.Linear(self.final_conv_size, self.global_vector_len)
                   )
         )
+        # TorchScript versions of the segments, by name (filled in by src.compilation.script_encoder); a plain
+        # dict, so they don't show up in the state dict
+        self.scripted_segments = {}
+
+    # the slices of self.layers the forward passes run, by name
+    layer_slices = {"f5": slice(0, 5), "f7": slice(0, 7), "f5-to-f7": slice(5, 7), "global-head": slice(5, None),
+                    "f7-to-global-vec": slice(7, None)}
 
     @property
     def local_vector_len(self):
         return self.layers[4].out_channels
 
+    def segment_names(self):
+        return list(self.layer_slices)
+
+    def segment(self, name):
+        """the module that runs segment name: a slice of self.layers, or its TorchScript version once the
+        encoder has been scripted"""
+        if name in self.scripted_segments:
+            return self.scripted_segments[name]
+        return self.layers[self.layer_slices[name]]
+
+    def run_segment(self, segment, module, x):
+        """module(x), with activation checkpointing if segment is in checkpoint_segments and we need grads"""
+        if segment in self.checkpoint_segments and self.training and torch.is_grad_enabled():
+            return checkpoint(module, x, use_reentrant=False)
+        return module(x)
+
     def get_f5(self, x):
-        return self.layers[:5](x)
+        return self.run_segment("f5", self.segment("f5"), x)
 
     def get_f7(self, x):
-        return self.layers[:7](x)
+        return self.segment("f7")(x)
 
     def f5_to_f7(self, f5):
-        return self.layers[5:7](f5)
+        return self.segment("f5-to-f7")(f5)
 
     def f5_to_global_vec(self, f5):
-        return self.layers[5:](f5)
+        return self.run_segment("global-head", self.segment("global-head"), f5)
 
     def f7_to_global_vec(self, f7):
-        return self.layers[7:](f7)
+        return self.segment("f7-to-global-vec")(f7)
+
+    def get_intermediates(self, x):
+        """runs the conv trunk once and returns every intermediate the losses need
+
+        Returns:
+            dict with "f5" (bs, local_vector_len, h, w) and "global_vec" (bs, global_vector_len)
+        """
+        f5 = self.get_f5(x)
+        global_vec = self.f5_to_global_vec(f5)
+        return dict(f5=f5, global_vec=global_vec)
 
     def forward(self, x):
-        global_vec = self.layers(x)
+        global_vec = self.f5_to_global_vec(self.get_f5(x))
         return global_vec
 
 
 class SlotSTDIMEncoder(STDIMEncoder):
-    def __init__(self, input_channels, ablations=[], num_slots=8, slot_len=32):
+    """ST-DIM encoder whose f5 channels are split into num_slots slot maps, each mapped to a slot vector by
+    the same (weight-tied) conv + linear slot head
+
+    Args:
+        fused_slot_head (bool): run the slot head as one grouped conv directly on f5 (see fused_slot_head)
+                                instead of over bs*num_slots reshaped slot maps; the parameters are the same
+    """
+    def __init__(self, input_channels, ablations=[], num_slots=8, slot_len=32, checkpoint_segments=(),
+                 fused_slot_head=False, input_size=(210, 160)):
         global_vector_len = 1 # for the last layer of st-dim which we don't use
         super().__init__(input_channels,
-                         global_vector_len=global_vector_len)
+                         global_vector_len=global_vector_len,
+                         checkpoint_segments=checkpoint_segments,
+                         input_size=input_size)
+        self.fused_slot_head = fused_slot_head
         self.num_slots = num_slots
         self.slot_len = slot_len
         self.feat_maps_per_slot_map = super().local_vector_len // num_slots
+        # the slot conv is a 3x3 stride 1 conv on f5 like f7, so its output has f7's spatial size
         self.final_conv_shape = [ self.feat_maps_per_slot_map // 2, *self.final_conv_shape[1:]]
-        self.final_conv_size = np.prod(self.final_conv_shape)
+        self.final_conv_size = int(np.prod(self.final_conv_shape))
 
         self.slot_layers = nn.Sequential(
             nn.Conv2d(self.feat_maps_per_slot_map, self.feat_maps_per_slot_map // 2, 3, stride=1),
@@ -105,15 +199,39 @@ class SlotSTDIMEncoder(STDIMEncoder):
                   )
         )
 
+    def segment_names(self):
+        return super().segment_names() + ["slot-head"]
 
+    def segment(self, name):
+        if name == "slot-head" and name not in self.scripted_segments:
+            return self.slot_layers
+        return super().segment(name)
 
     def forward(self, x):
+        if self.fused_slot_head:
+            return self.f5_to_slots(super().get_f5(x))
         slot_maps = self.get_slot_maps(x)
         slots = self.slot_maps_to_slots(slot_maps)
         return slots
 
+    def get_intermediates(self, x):
+        """runs the conv trunk once and returns every intermediate the losses need
+
+        Returns:
+            dict with "f5" (bs, num_channels, h, w),
+                      "slot_maps" (bs, num_slots, feat_maps_per_slot_map, h, w)
+                      and "slots" (bs, num_slots, slot_len)
+        """
+        f5 = super().get_f5(x)
+        slot_maps = self.f5_to_slot_maps(f5)
+        slots = self.f5_to_slots(f5) if self.fused_slot_head else self.slot_maps_to_slots(slot_maps)
+        return dict(f5=f5, slot_maps=slot_maps, slots=slots)
+
     def get_slot_maps(self, x):
         f5 = super().get_f5(x)
+        return self.f5_to_slot_maps(f5)
+
+    def f5_to_slot_maps(self, f5):
         bs, num_channels, h, w = f5.shape
         # in order for num_channels to evenly divide by num_slots
         # we subtract the remainder
@@ -130,12 +248,33 @@ class SlotSTDIMEncoder(STDIMEncoder):
         slot_map_4d = slot_maps.reshape(bs*num_slots, self.feat_maps_per_slot_map, h, w)
 
         # for each slot_map apply same conv layer + flatten + fc
-        all_slots = self.slot_layers(slot_map_4d)
+        all_slots = self.run_segment("slot-head", self.segment("slot-head"), slot_map_4d)
 
         # now we have number of examples by number of slots by slot_len
         slots = all_slots.reshape(bs, num_slots, -1)
         return slots
 
+    def f5_to_slots(self, f5):
+        """same result as slot_maps_to_slots(f5_to_slot_maps(f5)), computed straight from f5
+
+        The slot maps are consecutive channel groups of f5, so applying the shared slot conv to each of them
+        is one grouped conv over f5 with the conv weight tied (repeated) across the num_slots groups. Its
+        output channels are grouped by slot as well, so (bs, num_slots * c, h, w) -> (bs, num_slots, c*h*w)
+        is a view and the shared linear applies to all slots at once. No slot map is ever reshaped or copied.
+        """
+        return self.run_segment("slot-head", self._fused_slot_head, f5)
+
+    def _fused_slot_head(self, f5):
+        conv, fc = self.slot_layers[0], self.slot_layers[3]
+        chopped_num_channels = self.num_slots * self.feat_maps_per_slot_map
+        if f5.shape[1] != chopped_num_channels:
+            f5 = f5[:, :chopped_num_channels]  # a view, the conv reads it in place
+        weight = conv.weight.repeat(self.num_slots, 1, 1, 1)
+        bias = conv.bias.repeat(self.num_slots)
+        h = F.relu(F.conv2d(f5, weight, bias, stride=conv.stride, groups=self.num_slots))
+        h = h.reshape(h.shape[0], self.num_slots, -1)
+        return F.linear(h, fc.weight, fc.bias)
+
 
 class CSWMEncoder(nn.Module):
     def __init__(self,input_dim, width_height, output_dim, hidden_dim, num_objects, act_fn='relu'):
@@ -0,0 +1,115 @@
+import torch
+import torch.nn.functional as F
+
+
+def episodes_to_paths(episodes, actions, path_length):
+    """cuts episodes into non-overlapping paths of path_length transitions
+
+    Arguments:
+        episodes (list of torch.Tensor) -- frames of each episode, size (episode_len, C, H, W)
+        actions (list of torch.LongTensor) -- action taken at each frame of each episode, size (episode_len,)
+
+    Returns:
+        frames (torch.Tensor) -- size (num_paths, path_length + 1, C, H, W)
+        path_actions (torch.LongTensor) -- size (num_paths, path_length)
+    """
+    frames, path_actions = [], []
+    for ep_frames, ep_actions in zip(episodes, actions):
+        for start in range(0, len(ep_frames) - path_length, path_length + 1):
+            frames.append(ep_frames[start:start + path_length + 1])
+            path_actions.append(ep_actions[start:start + path_length])
+    return torch.stack(frames), torch.stack(path_actions)
+
+
+def to_path_batch(batch):
+    """(frames, actions) of a batch of paths, from either a TensorDataset batch or a cswm_utils.PathDataset batch
+    (which collates to a list of path_length + 1 observation batches and a list of path_length action batches)"""
+    frames, actions = batch
+    if isinstance(frames, (list, tuple)):
+        frames, actions = torch.stack(frames, dim=1), torch.stack(actions, dim=1)
+    return frames, actions
+
+
+@torch.no_grad()
+def rollout_batch(model, frames, actions, num_steps):
+    """encodes every frame of a batch of paths in one encoder call and rolls the transition model forward
+
+    Arguments:
+        model (ContrastiveSWM) -- trained model (encoder + transition_model)
+        frames (torch.Tensor) -- size (B, path_length + 1, C, H, W), uint8 frames are scaled to [0, 1]
+        actions (torch.LongTensor) -- size (B, path_length)
+        num_steps (list of int) -- rollout lengths to evaluate (each <= path_length)
+
+    Returns:
+        dict mapping each k in num_steps to (predicted state after k steps, encoded state at step k),
+        both flattened to size (B, num_objects * embedding_dim)
+    """
+    B, T = frames.shape[:2]
+    if not frames.is_floating_point():
+        frames = frames.float() / 255.
+    states = model.encoder(frames.reshape(B * T, *frames.shape[2:]))
+    states = states.reshape(B, T, *states.shape[1:])  # (B, T, num_objects, embedding_dim)
+
+    out = {}
+    pred = states[:, 0]
+    for step in range(max(num_steps)):
+        pred = pred + model.transition_model(pred, actions[:, step])
+        if step + 1 in num_steps:
+            out[step + 1] = (pred.flatten(1), states[:, step + 1].flatten(1))
+    return out
+
+
+def ranking_metrics(pred, target, hits_at=(1, 5, 10), chunk_size=1024):
+    """Hits@k and MRR of ranking each target among all targets by its distance to the matching prediction
+
+    Only (chunk_size, num_paths) distances exist at a time, so memory stays bounded for 10k+ paths. The rank of
+    the true target is one plus the number of targets strictly closer to the prediction, which is the same
+    as its position in a full sort (or topk) without doing one.
+
+    Arguments:
+        pred (torch.FloatTensor) -- predicted states, size (num_paths, d)
+        target (torch.FloatTensor) -- encoded true states, size (num_paths, d)
+
+    Returns:
+        dict with "hits_at_<k>" for each k in hits_at and "mrr"
+    """
+    ranks = []
+    for start in range(0, len(pred), chunk_size):
+        pred_chunk = pred[start:start + chunk_size]
+        dist = torch.cdist(pred_chunk, target)  # (chunk, num_paths)
+        true_dist = dist[torch.arange(len(pred_chunk)), torch.arange(start, start + len(pred_chunk))]
+        ranks.append(1 + (dist < true_dist[:, None]).sum(1))
+    ranks = torch.cat(ranks).float()
+    metrics = {"hits_at_%i" % k: (ranks <= k).float().mean().item() for k in hits_at}
+    metrics["mrr"] = (1. / ranks).mean().item()
+    return metrics
+
+
+def evaluate_rollouts(model, path_loader, num_steps=(1, 5, 10), hits_at=(1, 5, 10), chunk_size=1024,
+                      device=torch.device("cpu")):
+    """C-SWM multi-step latent prediction evaluation
+
+    Arguments:
+        model (ContrastiveSWM) -- trained model
+        path_loader (iterable) -- batches of (frames, actions) paths (see to_path_batch)
+        num_steps (list of int) -- rollout lengths to evaluate
+
+    Returns:
+        dict with "<metric>_step_<k>" for every ranking metric and rollout length k
+    """
+    model.eval()
+    num_steps = sorted(num_steps)
+    preds = {k: [] for k in num_steps}
+    targets = {k: [] for k in num_steps}
+    for batch in path_loader:
+        frames, actions = to_path_batch(batch)
+        out = rollout_batch(model, frames.to(device), actions.to(device), num_steps)
+        for k, (pred, target) in out.items():
+            preds[k].append(pred)
+            targets[k].append(target)
+
+    metrics = {}
+    for k in num_steps:
+        step_metrics = ranking_metrics(torch.cat(preds[k]), torch.cat(targets[k]), hits_at, chunk_size)
+        metrics.update({"%s_step_%i" % (name, k): v for name, v in step_metrics.items()})
+    return metrics
@@ -2,6 +2,7 @@ from sklearn.multioutput import MultiOutputRegressor
 from sklearn.linear_model import LinearRegression
 from sklearn.ensemble import GradientBoostingRegressor
 import numpy as np
+import torch
 import sys
 
 def get_feature_vectors(encoder, dataloader):
@@ -10,7 +11,8 @@ def get_feature_vectors(encoder, dataloader):
     labels = np.empty(shape=(0, num_state_variables))
     for x,y in dataloader:
         frames = x.float() / 255.
-        h = encoder(frames).detach().cpu().numpy()
+        with torch.no_grad():
+            h = encoder(frames).detach().cpu().numpy()
         vectors.append(h)
         labels = np.concatenate((labels, y))
     vectors = np.concatenate(vectors)
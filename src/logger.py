@@ -0,0 +1,127 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from src.running_metrics import RunningMetrics, window_means
+
+
+class MetricsLogger(RunningMetrics):
+    """Buffered, asynchronous metrics logger
+
+    Models and the training loop call log(dict) as often as they like. Everything logged within a step is
+    batched together and summed on the device (see RunningMetrics), and every `interval` steps the window
+    is handed to a background thread. That thread does the device->host copy and writes the means to
+    every backend, so neither the sync nor the backend I/O blocks the training step.
+
+    Args:
+        backends (list): objects with write(step, metrics) and close(), e.g. WandbBackend, JSONLBackend
+        interval (int): number of steps to aggregate over before flushing
+    """
+    def __init__(self, backends, interval=1):
+        super().__init__(log_fn=None, interval=interval)
+        self.backends = backends
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def flush(self):
+        if self.sums:
+            self.queue.put((self.num_steps, self.sums, self.counts))
+            self.sums, self.counts = {}, {}
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            step, sums, counts = item
+            means = window_means(sums, counts)
+            for backend in self.backends:
+                backend.write(step, means)
+
+    def close(self):
+        """flushes what is left, waits for the writer thread and closes the backends"""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        for backend in self.backends:
+            backend.close()
+
+
+class PrefixedLogger(object):
+    """logs everything as "<prefix>/<name>" into a shared logger, to give each of several models trained in
+    one run its own metric namespace
+
+    step() and flush() do nothing: the shared logger is stepped once per batch by whoever owns it, not once
+    per model
+    """
+    def __init__(self, logger, prefix):
+        self.logger = logger
+        self.prefix = prefix
+
+    def log(self, metrics):
+        self.logger.log({self.prefix + "/" + k: v for k, v in metrics.items()})
+
+    def step(self):
+        pass
+
+    def flush(self):
+        pass
+
+
+class WandbBackend(object):
+    def __init__(self, wandb):
+        self.wandb = wandb
+
+    def write(self, step, metrics):
+        self.wandb.log(metrics)
+
+    def close(self):
+        pass
+
+
+class JSONLBackend(object):
+    """appends one json object per flush: {"step": ..., "time": ..., <metric>: <value>, ...}"""
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, step, metrics):
+        record = dict(step=step, time=time.time())
+        record.update(metrics)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SQLiteBackend(object):
+    """writes rows of (step, time, name, value) to a `metrics` table"""
+    def __init__(self, path):
+        # the connection is only ever used by the logger's writer thread
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS metrics (step INTEGER, time REAL, name TEXT, value REAL)")
+        self.conn.commit()
+
+    def write(self, step, metrics):
+        now = time.time()
+        self.conn.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?)",
+                              [(step, now, k, v) for k, v in metrics.items()])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def get_logger(backend_names, log_dir, interval=1, wandb=None):
+    """builds a MetricsLogger writing to the named backends ("wandb", "jsonl", "sqlite")"""
+    backends = []
+    if "wandb" in backend_names:
+        backends.append(WandbBackend(wandb))
+    if "jsonl" in backend_names:
+        backends.append(JSONLBackend(os.path.join(log_dir, "metrics.jsonl")))
+    if "sqlite" in backend_names:
+        backends.append(SQLiteBackend(os.path.join(log_dir, "metrics.sqlite")))
+    return MetricsLogger(backends, interval=interval)
@@ -0,0 +1,199 @@
+import copy
+import os
+import threading
+import time
+import warnings
+import torch
+from src.baselines.cswm import ContrastiveSWM
+from src.baselines.slot_stdim import SlotSTDIMModel
+from src.baselines.stdim import STDIMModel
+from src.running_metrics import RunningMetrics
+from src.scn import SCNModel
+from src.utils import get_autocast
+
+
+def peak_memory(fn, device):
+    """runs fn() and returns (fn's output, peak memory in bytes above what was in use before)
+
+    on cuda this is the allocator's peak; on cpu it's the peak resident set size, sampled every millisecond
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        before = torch.cuda.memory_allocated()
+        out = fn()
+        torch.cuda.synchronize()
+        return out, torch.cuda.max_memory_allocated() - before
+
+    import psutil
+    process = psutil.Process(os.getpid())
+    before = process.memory_info().rss
+    peak = [before]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], process.memory_info().rss)
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        out = fn()
+    finally:
+        done.set()
+        sampler.join()
+    return out, max(peak[0], process.memory_info().rss) - before
+
+
+def default_memory_budget(device):
+    """90% of the gpu's memory, or half of the currently available host memory on cpu"""
+    if device.type == "cuda":
+        return 0.9 * torch.cuda.get_device_properties(device).total_memory
+    import psutil
+    return 0.5 * psutil.virtual_memory().available
+
+
+def encoder_activation_sizes(encoder, sample_frame):
+    """(elements of every module output for one frame, (h, w) of f5), from one forward pass on a dummy frame
+
+    module outputs are what autograd keeps around for the backward pass, so their sum is the per-frame
+    activation memory of a training step
+    """
+    sizes = []
+    hooks = [m.register_forward_hook(lambda m, inp, out: sizes.append(out.numel()))
+             for m in encoder.modules() if len(list(m.children())) == 0]
+    frame = torch.zeros(1, *sample_frame.shape[1:], device=next(encoder.parameters()).device)
+    was_training = encoder.training
+    encoder.eval()
+    try:
+        with torch.no_grad():
+            out = encoder.get_intermediates(frame) if hasattr(encoder, "get_intermediates") else encoder(frame)
+    finally:
+        for hook in hooks:
+            hook.remove()
+        encoder.train(was_training)
+    f5_hw = tuple(out["f5"].shape[-2:]) if isinstance(out, dict) else (1, 1)
+    return sum(sizes), f5_hw
+
+
+def logits_elements(model, args, batch_size, f5_hw):
+    """number of logits one training step of model builds for a batch of batch_size"""
+    N = batch_size
+    hw = f5_hw[0] * f5_hw[1]
+    # number of negatives each anchor is scored against
+    num_cols = N if args.num_sampled_negatives <= 0 else 1 + args.num_sampled_negatives
+    chunk_rows = args.loss_chunk_size if args.loss_chunk_size > 0 else N
+    if isinstance(model, SlotSTDIMModel):
+        S = model.encoder.num_slots
+        cols = {"scn": S * N * (num_cols + args.queue_len),
+                "sdl": N * S * S,
+                "hcn": S * hw * N * num_cols,
+                "smcn": S * hw * N * num_cols,
+                "smdl": N * hw * S * S}
+        if args.num_sampled_negatives <= 0 and args.loss_chunk_size > 0:
+            # blocked InfoNCE only ever holds chunk_size rows of each N x N matrix
+            cols["hcn"] = cols["smcn"] = S * hw * min(chunk_rows, N) * N
+        return sum(cols[loss] for loss in model.losses_to_use if loss in cols)
+    if isinstance(model, SCNModel):
+        S = model.num_slots
+        return S * N * (num_cols + args.queue_len) + N * S * S
+    if isinstance(model, STDIMModel):
+        return hw * N * N + hw * min(chunk_rows, N) * N
+    if isinstance(model, ContrastiveSWM):
+        return N * N if model.num_negatives != 1 else N
+    return 0
+
+
+def estimate_peak_bytes(model, args, batch_size, sample_frame, activation_bytes=4):
+    """analytic peak memory of one training step (Adam) at batch_size
+
+    parameters + gradients + two Adam moments, the encoder activations of xt and xtp1 and every logit tensor
+    of the active losses (the N^2 term)
+    """
+    param_bytes = 4 * 4 * sum(p.numel() for p in model.parameters())
+    per_frame, f5_hw = encoder_activation_sizes(model.encoder, sample_frame)
+    activations = 2 * batch_size * per_frame * activation_bytes
+    # logits are kept in the compute dtype, cast to fp32 for the cross entropy, and their gradient is fp32 too
+    logits = logits_elements(model, args, batch_size, f5_hw) * (activation_bytes + 4 + 4)
+    return param_bytes + activations + logits
+
+
+def largest_batch_size(estimate_fn, budget, max_batch_size=1 << 16):
+    """largest batch size whose estimate_fn(batch_size) fits in budget (binary search, estimates are monotonic)"""
+    low, high = 1, max_batch_size
+    if estimate_fn(low) > budget:
+        return 0
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_fn(mid) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def measure_step_bytes(model, sample_frame, batch_size, device, precision="fp32", num_steps=2):
+    """peak memory of num_steps training steps on random frames, run on a copy so model is left untouched"""
+    # the model's logger owns a writer thread, which can't be copied, and shouldn't see the probing steps anyway
+    logger = getattr(model, "logger", None)
+    memo = {id(logger): RunningMetrics(log_fn=None)} if logger is not None else {}
+    model = copy.deepcopy(model, memo).train()
+    optimizer = torch.optim.Adam(model.parameters())
+    frame_shape = sample_frame.shape[1:]
+    param_bytes = 4 * sum(p.numel() for p in model.parameters())
+
+    def steps():
+        for _ in range(num_steps):
+            xt = torch.rand(batch_size, *frame_shape, device=device)
+            xtp1 = torch.rand(batch_size, *frame_shape, device=device)
+            a = torch.zeros(batch_size, dtype=torch.long, device=device)
+            optimizer.zero_grad()
+            with get_autocast(device, precision):
+                loss = model.calc_loss(xt, a, xtp1)
+            loss.backward()
+            optimizer.step()
+
+    _, peak = peak_memory(steps, device)
+    # the copy's parameters were allocated before measuring, but count towards the budget
+    return peak + param_bytes
+
+
+def find_batch_size(model, args, sample_frame, device, budget, max_tries=4):
+    """picks the largest batch size that fits budget: analytic estimate first, then checked by probing runs
+
+    if a probing run needs more than the budget, the batch size is shrunk by the measured overshoot
+    (as if memory grew quadratically in the batch size) and probed again, up to max_tries times, then halved
+    until a probe fits; a batch size of 1 that still doesn't fit is returned with a warning
+
+    Returns:
+        batch_size (int), estimated peak bytes (int), measured peak bytes (int)
+    """
+    precision = getattr(args, "precision", "fp32")
+    activation_bytes = 2 if precision != "fp32" else 4
+    estimate = lambda n: estimate_peak_bytes(model, args, n, sample_frame, activation_bytes)
+    batch_size = largest_batch_size(estimate, budget)
+    assert batch_size > 0, "even a batch size of 1 doesn't fit in a %.2f GB budget" % (budget / 2**30)
+
+    def probe(batch_size):
+        try:
+            measured = measure_step_bytes(model, sample_frame, batch_size, device, precision)
+        except RuntimeError:  # out of memory
+            measured = 2 * budget
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+        return measured
+
+    measured = probe(batch_size)
+    for _ in range(max_tries - 1):
+        if measured <= budget or batch_size == 1:
+            break
+        batch_size = max(1, int(0.95 * batch_size * (budget / measured) ** 0.5))
+        measured = probe(batch_size)
+    while measured > budget and batch_size > 1:
+        batch_size //= 2
+        measured = probe(batch_size)
+    if measured > budget:
+        warnings.warn("a batch size of 1 measured %.2f GB, over the %.2f GB memory budget"
+                      % (measured / 2**30, budget / 2**30))
+    return batch_size, estimate(batch_size), measured
@@ -0,0 +1,121 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.func import functional_call, stack_module_state, vmap
+
+
+class _CalcLoss(nn.Module):
+    """exposes model.calc_loss as forward, which is what functional_call calls"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *batch):
+        return self.model.calc_loss(*batch)
+
+
+class _Recorder(object):
+    """stands in for the logger inside the vmapped loss, so the (batched) logged values can be returned instead"""
+    def __init__(self):
+        self.metrics = {}
+
+    def log(self, metrics):
+        for k, v in metrics.items():
+            self.metrics[k] = v.detach() if torch.is_tensor(v) else v
+
+    def step(self):
+        pass
+
+
+class MultiSeedModel(nn.Module):
+    """S independently initialized copies of a model, trained on the same batches in one vmapped step
+
+    The parameters and buffers of the copies are stacked along a new leading seed dimension and calc_loss runs
+    the copies' calc_loss with torch.func.vmap over that dimension, so every kernel (forward and backward)
+    runs once for all seeds instead of once per seed. The seeds never share a parameter, so the gradient of
+    the summed loss with respect to seed i's slice is exactly the gradient of seed i's own loss; with an
+    elementwise optimizer (Adam) this is the same as S separate runs on the same data stream.
+
+    The original models are kept around so seed_model(i) can hand out seed i's weights as a regular model
+    (e.g. for saving its encoder).
+
+    Arguments:
+        models (list of nn.Module) -- S models of identical structure with a calc_loss method, on one device
+        logger -- gets the mean over seeds of everything the models log, plus "<name>_seed<i>" per seed
+    """
+    def __init__(self, models, logger=None):
+        super().__init__()
+        self.num_seeds = len(models)
+        self.logger = logger
+        self.last_losses = None
+        # the structure the stacked parameters are plugged into; it logs into a recorder instead of the logger
+        self.recorder = _Recorder()
+        model_logger = getattr(models[0], "logger", None)
+        memo = {id(model_logger): self.recorder} if model_logger is not None else {}
+        base = copy.deepcopy(models[0], memo)
+        if hasattr(base, "logger"):
+            base.logger = self.recorder
+        object.__setattr__(self, "base", _CalcLoss(base).to("meta"))
+
+        params, buffers = stack_module_state(models)
+        self.param_names = list(params)
+        self.buffer_names = list(buffers)
+        self.stacked_params = nn.ParameterList([nn.Parameter(params[name]) for name in self.param_names])
+        for i, name in enumerate(self.buffer_names):
+            self.register_buffer("stacked_buffer_%i" % i, buffers[name])
+
+        # a plain attribute, so the original models don't show up in parameters() / state_dict()
+        object.__setattr__(self, "seed_models", models)
+
+    def stacked_buffer(self, i):
+        return getattr(self, "stacked_buffer_%i" % i)
+
+    def stacked_state(self):
+        """{name in the original model: stacked parameter or buffer}"""
+        state = dict(zip(self.param_names, self.stacked_params))
+        state.update((name, self.stacked_buffer(i)) for i, name in enumerate(self.buffer_names))
+        return state
+
+    @torch.no_grad()
+    def seed_model(self, seed):
+        """the original model of seed, with that seed's current parameters and buffers copied into it"""
+        model = self.seed_models[seed]
+        stacked = self.stacked_state()
+        for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+            tensor.copy_(stacked[name][seed])
+        return model
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.base.train(mode)
+        return self
+
+    def _seed_loss(self, params, buffers, *batch):
+        self.recorder.metrics = {}
+        loss = functional_call(self.base, (params, buffers), batch)
+        metrics = {k: v if torch.is_tensor(v) else torch.tensor(float(v)) for k, v in self.recorder.metrics.items()}
+        return loss, metrics
+
+    def seed_losses(self, *batch):
+        """per-seed losses (S,) and per-seed logged metrics, each (S,), for one batch shared by all seeds"""
+        params = {"model." + name: p for name, p in zip(self.param_names, self.stacked_params)}
+        buffers = {"model." + name: self.stacked_buffer(i) for i, name in enumerate(self.buffer_names)}
+        in_dims = (0, 0) + (None,) * len(batch)
+        # every seed draws its own negatives / permutations
+        return vmap(self._seed_loss, in_dims=in_dims, randomness="different")(params, buffers, *batch)
+
+    def calc_loss(self, *batch):
+        """sum of the per-seed losses; logs their mean and every seed's value
+
+        the per-seed losses are kept (detached) in last_losses, e.g. to track each seed's best val loss
+        """
+        losses, metrics = self.seed_losses(*batch)
+        self.last_losses = losses.detach()
+        if self.logger is not None:
+            metrics["loss"] = losses.detach()
+            prefix = "tr_" if self.training else "val_"
+            metrics = {k if k.startswith(("tr_", "val_")) else prefix + k: v for k, v in metrics.items()}
+            for k, v in metrics.items():
+                self.logger.log({k + "_seed_mean": v.mean()})
+                self.logger.log({"%s_seed%i" % (k, seed): v[seed] for seed in range(self.num_seeds)})
+        return losses.sum()
@@ -0,0 +1,138 @@
+import math
+import torch
+from src.distributed import get_world_size
+
+
+class LARS(torch.optim.Optimizer):
+    """SGD with momentum and a layer-wise adaptive learning rate (You et al. 2017)
+
+    each parameter tensor's update is scaled by trust_coef * ||w|| / ||g + weight_decay * w||, so every layer
+    moves by roughly the same relative amount regardless of its gradient scale. Biases and norm parameters
+    (1-d tensors) skip the adaptation and the weight decay, as usual.
+    """
+    def __init__(self, params, lr, momentum=0.9, weight_decay=1e-6, trust_coef=0.001, eps=1e-8):
+        defaults = dict(lr=lr, momentum=momentum, weight_decay=weight_decay, trust_coef=trust_coef, eps=eps)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                update = p.grad
+                if p.dim() > 1:
+                    update = update.add(p, alpha=group["weight_decay"])
+                    w_norm, u_norm = torch.norm(p), torch.norm(update)
+                    trust_ratio = torch.where((w_norm > 0) & (u_norm > 0),
+                                              group["trust_coef"] * w_norm / (u_norm + group["eps"]),
+                                              torch.ones_like(w_norm))
+                    update = update.mul(trust_ratio)
+                state = self.state[p]
+                if "momentum_buffer" not in state:
+                    state["momentum_buffer"] = torch.clone(update).detach()
+                else:
+                    state["momentum_buffer"].mul_(group["momentum"]).add_(update)
+                p.add_(state["momentum_buffer"], alpha=-group["lr"])
+        return loss
+
+
+class LAMB(torch.optim.Optimizer):
+    """Adam with a layer-wise trust ratio (You et al. 2019)
+
+    the Adam update (plus decoupled weight decay) of each parameter tensor is rescaled by ||w|| / ||update||;
+    1-d tensors (biases, norms) use the plain Adam update
+    """
+    def __init__(self, params, lr, betas=(0.9, 0.999), eps=1e-6, weight_decay=0.0):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                state = self.state[p]
+                if not state:
+                    state["step"] = 0
+                    state["exp_avg"] = torch.zeros_like(p)
+                    state["exp_avg_sq"] = torch.zeros_like(p)
+                state["step"] += 1
+                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+                exp_avg.mul_(beta1).add_(p.grad, alpha=1 - beta1)
+                exp_avg_sq.mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+                exp_avg_hat = exp_avg / (1 - beta1 ** state["step"])
+                exp_avg_sq_hat = exp_avg_sq / (1 - beta2 ** state["step"])
+                update = exp_avg_hat / (exp_avg_sq_hat.sqrt() + group["eps"])
+                if p.dim() > 1:
+                    update.add_(p, alpha=group["weight_decay"])
+                    w_norm, u_norm = torch.norm(p), torch.norm(update)
+                    trust_ratio = torch.where((w_norm > 0) & (u_norm > 0), w_norm / u_norm, torch.ones_like(w_norm))
+                    update.mul_(trust_ratio)
+                p.add_(update, alpha=-group["lr"])
+        return loss
+
+
+def scale_lr(lr, batch_size, base_batch_size=256, rule="none"):
+    """learning rate for batch_size, given lr tuned at base_batch_size ("linear" or "sqrt" scaling)"""
+    if rule == "linear":
+        return lr * batch_size / base_batch_size
+    if rule == "sqrt":
+        return lr * math.sqrt(batch_size / base_batch_size)
+    return lr
+
+
+def warmup_cosine(warmup_steps, total_steps):
+    """LambdaLR multiplier: linear warmup from 0 over warmup_steps, then cosine decay to 0 at total_steps"""
+    def lr_lambda(step):
+        if step < warmup_steps:
+            return (step + 1) / warmup_steps
+        progress = (step - warmup_steps) / max(1, total_steps - warmup_steps)
+        return 0.5 * (1 + math.cos(math.pi * min(progress, 1.0)))
+    return lr_lambda
+
+
+def get_lr(args):
+    """the learning rate for args.optimizer at the global batch size
+
+    without an explicit --lr, lars gets the usual 0.1 * batch / 256 of the reference recipes (its trust ratio
+    already shrinks the update by trust_coef, so adam's 3e-4 would barely move the weights) and adam / lamb get
+    3e-4, scaled by --lr-scaling
+    """
+    # --batch-size is per process, the lr is scaled to the global batch
+    batch_size = args.batch_size * get_world_size()
+    if args.lr is None and args.optimizer == "lars":
+        return 0.1 * batch_size / 256
+    lr = 3e-4 if args.lr is None else args.lr
+    return scale_lr(lr, batch_size, args.base_batch_size, args.lr_scaling)
+
+
+def get_optimizer(params, args, steps_per_epoch):
+    """builds the optimizer and per-step lr scheduler selected by args
+
+    Returns:
+        optimizer, scheduler (None for --lr-schedule constant)
+    """
+    lr = get_lr(args)
+    if args.optimizer == "lars":
+        optimizer = LARS(params, lr=lr, weight_decay=args.weight_decay)
+    elif args.optimizer == "lamb":
+        optimizer = LAMB(params, lr=lr, weight_decay=args.weight_decay)
+    else:
+        optimizer = torch.optim.Adam(params, lr=lr, weight_decay=args.weight_decay)
+
+    if args.lr_schedule == "constant":
+        return optimizer, None
+    warmup_steps = max(1, int(args.warmup_epochs * steps_per_epoch))
+    lr_lambda = warmup_cosine(warmup_steps, args.epochs * steps_per_epoch)
+    return optimizer, torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda)
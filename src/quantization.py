@@ -0,0 +1,78 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+from src.encoders import STDIMEncoder, SlotSTDIMEncoder
+
+
+class QuantizedEncoder(nn.Module):
+    """int8 version of an ST-DIM style encoder for cpu feature extraction
+
+    takes and returns float tensors; everything in between (convs, relus, slot reshapes, linears) runs on
+    per-tensor quantized int8 tensors"""
+    def __init__(self, encoder):
+        super().__init__()
+        self.quant = quantization.QuantStub()
+        self.encoder = encoder
+        self.dequant = quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.encoder(self.quant(x)))
+
+
+def fuse_encoder(encoder):
+    """fuses every conv with the ReLU after it, in place
+
+    the f5 conv is only fused for STDIMEncoder: the slot maps of SlotSTDIMEncoder are taken before that ReLU
+    """
+    conv_relus = [["0", "1"], ["2", "3"], ["6", "7"]]
+    if not isinstance(encoder, SlotSTDIMEncoder):
+        conv_relus.append(["4", "5"])
+    quantization.fuse_modules(encoder.layers, conv_relus, inplace=True)
+    if isinstance(encoder, SlotSTDIMEncoder):
+        quantization.fuse_modules(encoder.slot_layers, [["0", "1"]], inplace=True)
+    return encoder
+
+
+def quantize_encoder(encoder, calibration_frames, backend="fbgemm", batch_size=256):
+    """post-training static int8 quantization of a (Slot)STDIMEncoder
+
+    Arguments:
+        encoder (STDIMEncoder) -- trained fp32 encoder, left untouched
+        calibration_frames (torch.FloatTensor) -- (N, C, H, W) sample of training frames, scaled like the
+                                                  encoder's inputs, used to pick the activation ranges
+        backend (str) -- quantized engine, "fbgemm" for x86 and "qnnpack" for arm
+
+    Returns:
+        QuantizedEncoder on the cpu
+    """
+    assert isinstance(encoder, STDIMEncoder), "only the ST-DIM encoders can be quantized"
+    torch.backends.quantized.engine = backend
+    encoder = copy.deepcopy(encoder).cpu().eval()
+    if isinstance(encoder, SlotSTDIMEncoder):
+        # the grouped conv of the fused slot head reads the float slot_layers weights directly
+        encoder.fused_slot_head = False
+    encoder = fuse_encoder(encoder)
+    model = QuantizedEncoder(encoder).eval()
+    model.qconfig = quantization.get_default_qconfig(backend)
+    if isinstance(encoder, SlotSTDIMEncoder):
+        # the global head of the slot encoder is never run, so don't observe/quantize it
+        for module in encoder.layers[5:]:
+            module.qconfig = None
+    quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for frames in calibration_frames.split(batch_size):
+            model(frames.cpu())
+    quantization.convert(model, inplace=True)
+    return model
+
+
+def get_calibration_frames(dataloader, num_frames):
+    """the first num_frames frames of a probe dataloader (which yields uint8 (frames, labels)), scaled to [0, 1]"""
+    frames, count = [], 0
+    for x, _ in dataloader:
+        frames.append(x.float() / 255.)
+        count += len(x)
+        if count >= num_frames:
+            break
+    return torch.cat(frames)[:num_frames]
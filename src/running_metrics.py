@@ -0,0 +1,82 @@
+import torch
+
+_target_cache = {}
+
+
+def diagonal_target(n, num_repeats, device):
+    """Target for num_repeats stacked n x n score matrices whose positives lie on the diagonal
+
+    Equivalent to torch.arange(n).repeat(num_repeats).to(device), but built once per (n, num_repeats, device)
+    and then reused, so the losses don't rebuild and copy it to the device every step.
+    """
+    key = (n, num_repeats, str(device))
+    if key not in _target_cache:
+        _target_cache[key] = torch.arange(n, device=device).repeat(num_repeats)
+    return _target_cache[key]
+
+
+def zero_target(num_rows, device):
+    """Target for logits whose positive is always in column 0 (e.g. sampled softmax), cached like diagonal_target"""
+    key = (num_rows, str(device))
+    if key not in _target_cache:
+        _target_cache[key] = torch.zeros(num_rows, dtype=torch.long, device=device)
+    return _target_cache[key]
+
+
+def contrastive_accuracy(logits, target):
+    """fraction of rows of logits whose argmax is the target, as a 0-dim tensor that stays on the device"""
+    guesses = torch.argmax(logits.detach(), dim=1)
+    return torch.eq(guesses, target).to(torch.float).mean()
+
+
+class RunningMetrics(object):
+    """Accumulates logged metrics on the device and only syncs with the host every `interval` steps
+
+    It has the same log(dict) interface as the wandb module, so the models can log every step without paying
+    a device->host sync each time. Values can be python numbers or tensors (tensors are detached and summed
+    where they live). Every `interval` calls to step() the window means are copied to the host in a single
+    transfer and handed to log_fn.
+
+    Args:
+        log_fn (callable): receives a dict of floats, e.g. wandb.log
+        interval (int): how many steps to aggregate over before syncing
+    """
+    def __init__(self, log_fn, interval=1):
+        self.log_fn = log_fn
+        self.interval = max(interval, 1)
+        self.num_steps = 0
+        self.sums = {}
+        self.counts = {}
+
+    def log(self, metrics):
+        for k, v in metrics.items():
+            if torch.is_tensor(v):
+                v = v.detach()
+            # out of place add, so we never modify a tensor somebody else still holds
+            self.sums[k] = self.sums[k] + v if k in self.sums else v
+            self.counts[k] = self.counts.get(k, 0) + 1
+
+    def step(self):
+        self.num_steps += 1
+        if self.num_steps % self.interval == 0:
+            self.flush()
+
+    def compute(self):
+        """window means as python floats (the only place a sync happens)"""
+        return window_means(self.sums, self.counts)
+
+    def flush(self):
+        if self.sums:
+            means = self.compute()
+            self.sums, self.counts = {}, {}
+            self.log_fn(means)
+
+
+def window_means(sums, counts):
+    """turns running sums (python numbers or device tensors) into means as python floats with one host transfer"""
+    tensor_keys = [k for k, v in sums.items() if torch.is_tensor(v)]
+    means = {k: float(v) / counts[k] for k, v in sums.items() if k not in tensor_keys}
+    if tensor_keys:
+        stacked = torch.stack([(sums[k] / counts[k]).to(torch.float).reshape(()) for k in tensor_keys])
+        means.update(zip(tensor_keys, stacked.cpu().tolist()))
+    return means
@@ -1,41 +1,72 @@
 import torch
 import torch.nn as nn
-from src.utils import calculate_accuracy
+from src.running_metrics import diagonal_target, zero_target, contrastive_accuracy
+from src.encoders import encode_pair
+from src.contrastive import SlotNegativeQueue, sample_negatives, sampled_logits
+from src.distributed import gather_batch, offset_target, is_distributed
 
 class SCNModel(nn.Module):
-    def __init__(self, args, encoder, device=torch.device('cpu'), wandb=None, ablations=[]):
+    def __init__(self, args, encoder, device=torch.device('cpu'), logger=None, ablations=[]):
         super().__init__()
         self.encoder = encoder
         self.args = args
-        self.wandb = wandb
+        self.logger = logger
         self.num_slots = self.args.num_slots
         self.slot_len = self.args.slot_len
         self.ablations = ablations
         self.score_matrix_1 = nn.Linear(self.slot_len, self.slot_len)
         self.score_matrix_2 = nn.Linear(self.slot_len, self.slot_len)
         self.device = device
+        self.negative_queue = None
+        if self.args.queue_len > 0:
+            self.negative_queue = SlotNegativeQueue(encoder, self.num_slots, self.slot_len,
+                                                    self.args.queue_len, self.args.queue_momentum)
 
-    def calc_loss1(self, slots_t, slots_pos):
+    def calc_loss1(self, slots_t, slots_pos, negatives=None):
         """Loss 1: Does a pair of slot vectors from the same slot
                    come from consecutive (or within a small window) time steps or not?"""
         batch_size, num_slots, slot_len = slots_t.shape
 
-        # logits: num_slots x batch_size x batch_size
-        #        for each slot, for each example in the batch, dot prodcut with every other example in batch
-        logits = torch.matmul(self.score_matrix_1(slots_t).transpose(1, 0),
-                              slots_pos.permute(1, 2, 0))
+        queries = self.score_matrix_1(slots_t).transpose(1, 0)
+        if negatives is not None:
+            # logits: num_slots x batch_size x (1 + K)
+            #        for each slot, for each example in the batch, dot product with its positive (column 0)
+            #        and the K sampled negatives
+            logits = sampled_logits(queries, slots_pos.transpose(1, 0), negatives)
+            target = zero_target(num_slots*batch_size, self.device)
+            if self.args.symmetric_loss:
+                # there is no transpose to reuse, so score the t+1 anchors against the sampled t candidates
+                reverse_logits = sampled_logits(slots_pos.transpose(1, 0), queries, negatives)
+        else:
+            # logits: num_slots x batch_size x batch_size
+            #        for each slot, for each example in the batch, dot prodcut with every other example in batch
+            #        (of the global batch when training data parallel, so the positive sits at offset + i)
+            all_slots_pos, offset = gather_batch(slots_pos, dim=0)
+            logits = torch.matmul(queries, all_slots_pos.permute(1, 2, 0))
+            target = offset_target(diagonal_target(batch_size, num_slots, self.device), offset)
+            if self.args.symmetric_loss and not is_distributed():
+                # the t+1 -> t logits are the transpose: row j scores slots_pos[j] against every slots_t
+                reverse_logits = logits.transpose(1, 2)
+            elif self.args.symmetric_loss:
+                # with a gathered batch the transpose has the wrong rows, so score the local t+1 slots
+                # against the gathered t queries instead
+                all_queries, _ = gather_batch(queries, dim=1)
+                reverse_logits = torch.matmul(slots_pos.transpose(1, 0), all_queries.transpose(1, 2))
+        if self.negative_queue is not None:
+            # slot vectors from past batches as extra negatives (appended after the columns above)
+            logits = torch.cat([logits, self.negative_queue.extra_logits(queries)], dim=-1)
 
         inp = logits.reshape(num_slots*batch_size, -1)
-        target = torch.cat([torch.arange(batch_size) for i in range(num_slots)]).to(self.device)
-        loss1 = nn.CrossEntropyLoss()(inp, target)
-        acc1 = calculate_accuracy(inp.detach().cpu().numpy(), target.detach().cpu().numpy())
+        loss1 = nn.CrossEntropyLoss()(inp.float(), target)
+        acc1 = contrastive_accuracy(inp, target)
+        if self.args.symmetric_loss:
+            reverse_inp = reverse_logits.reshape(num_slots*batch_size, -1)
+            loss1 = (loss1 + nn.CrossEntropyLoss()(reverse_inp.float(), target)) / 2
 
         if self.training:
-            self.wandb.log({"tr_acc1": acc1})
-            self.wandb.log({"tr_loss1": loss1.item()})
+            self.logger.log({"tr_acc1": acc1, "tr_loss1": loss1})
         else:
-            self.wandb.log({"val_acc1": acc1})
-            self.wandb.log({"val_loss1": loss1.item()})
+            self.logger.log({"val_acc1": acc1, "val_loss1": loss1})
         return loss1
 
 
@@ -50,25 +81,29 @@ class SCNModel(nn.Module):
         logits = torch.matmul(self.score_matrix_2(slots_t),
                               slots_pos.transpose(2,1))
         inp = logits.reshape(batch_size * num_slots, -1)
-        target = torch.cat([torch.arange(num_slots) for i in range(batch_size)]).to(self.device)
-        loss2 = nn.CrossEntropyLoss()(inp, target)
-        acc2  = calculate_accuracy(inp.detach().cpu().numpy(), target.detach().cpu().numpy())
+        target = diagonal_target(num_slots, batch_size, self.device)
+        loss2 = nn.CrossEntropyLoss()(inp.float(), target)
+        acc2 = contrastive_accuracy(inp, target)
         if self.training:
-            self.wandb.log({"tr_acc2": acc2})
-            self.wandb.log({"tr_loss2": loss2.item()})
+            self.logger.log({"tr_acc2": acc2, "tr_loss2": loss2})
         else:
-            self.wandb.log({"val_acc2": acc2})
-            self.wandb.log({"val_loss2": loss2.item()})
+            self.logger.log({"val_acc2": acc2, "val_loss2": loss2})
         return loss2
 
 
-    def calc_loss(self, xt, a, xtp1):
-        slots_t, slots_pos = self.encoder(xt), self.encoder(xtp1)
-        loss1 = self.calc_loss1(slots_t, slots_pos)
+    def calc_loss(self, xt, a, xtp1, episode_ids=None):
+        slots_t, slots_pos = encode_pair(self.encoder, xt, xtp1,
+                                         concat=self.args.concat_forward)
+        negatives = None
+        if self.args.num_sampled_negatives > 0:
+            negatives = sample_negatives(xt.shape[0], self.args.num_sampled_negatives, xt.device, episode_ids)
+        loss1 = self.calc_loss1(slots_t, slots_pos, negatives)
         if "loss1-only" in self.ablations:
             loss = loss1
         else:
             loss2 = self.calc_loss2(slots_t, slots_pos)
             loss = loss1 + loss2
+        if self.negative_queue is not None and self.training:
+            self.negative_queue.update(self.encoder, xtp1)
         return loss
 
@@ -4,7 +4,6 @@ import torch
 import numpy as np
 from sklearn.metrics import f1_score as compute_f1_score
 from collections import defaultdict
-import psutil
 import wandb
 from atariari.benchmark.categorization import summary_key_dict
 from scipy.stats import entropy
@@ -118,6 +117,7 @@ def get_channels(args):
     return num_channels
 
 def print_memory(name=""):
+    import psutil  # only needed here, so importing the training code doesn't require it
     process = psutil.Process(os.getpid())
     print("%3.4f GB for %s"%(process.memory_info().rss / 2**30,name), flush=True)  # in bytes
 
@@ -143,6 +143,26 @@ def set_seeds(seed):
         torch.backends.cudnn.benchmark = False
         torch.backends.cudnn.deterministic = True
 
+_autocast_dtypes = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def get_autocast(device, precision="fp32"):
+    """autocast context for the forward pass + loss at the given precision ("fp32", "bf16" or "fp16")
+
+    convs and matmuls run in the low precision dtype, while autocast keeps softmax/log_softmax and
+    cross entropy in fp32. "fp32" returns a disabled context, so callers can always wrap their forward in it.
+    """
+    dtype = _autocast_dtypes.get(precision, torch.bfloat16)
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=precision != "fp32")
+
+
+def get_grad_scaler(device, precision="fp32"):
+    """loss scaler for fp16 training; bf16 has the exponent range of fp32, so it (and fp32) get a no-op scaler"""
+    enabled = precision == "fp16"
+    assert not enabled or device.type == "cuda", "fp16 training is only supported on cuda, use bf16 on cpu"
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
 def calculate_multiple_f1_scores(preds, labels):
     if len(labels.shape) == 1:
         return calculate_multiclass_f1_score(preds, labels)